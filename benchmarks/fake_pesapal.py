@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Pesapal v3 API, for load tests and benchmarks.
+
+    python benchmarks/fake_pesapal.py --port 9090 --latency 0.2 --error-rate 0.01 --completion-delay 10
+
+Point the app at it with PESAPAL_BASE_URL=http://127.0.0.1:9090. Serves
+Auth/RequestToken, Transactions/SubmitOrderRequest and
+Transactions/GetTransactionStatus. Orders report "Pending" until --completion-delay
+seconds after submission and --final-status afterwards. GET /__stats returns
+per-endpoint call counts.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN_LIFETIME = timedelta(minutes=5)
+
+
+class FakePesapal:
+    """State and behaviour of the fake API; shared by all handler threads."""
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, completion_delay=5.0,
+                 final_status="Completed", seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.completion_delay = completion_delay
+        self.final_status = final_status
+        self.random = random.Random(seed)
+        self.orders = {}
+        self.tokens = set()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def request_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(token)
+        expiry = datetime.now(timezone.utc) + TOKEN_LIFETIME
+        return 200, {
+            "token": token,
+            "expiryDate": expiry.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "error": None,
+            "status": "200",
+            "message": "Request processed successfully",
+        }
+
+    def submit_order(self, payload):
+        if not payload.get("id") or not payload.get("amount"):
+            return 400, {"error": {"code": "invalid_request", "message": "id and amount are required"}, "status": "400"}
+        tracking_id = str(uuid.uuid4())
+        with self.lock:
+            self.orders[tracking_id] = {
+                "merchant_reference": payload["id"],
+                "amount": payload["amount"],
+                "currency": payload.get("currency", "KES"),
+                "submitted": time.monotonic(),
+            }
+        return 200, {
+            "order_tracking_id": tracking_id,
+            "merchant_reference": payload["id"],
+            "redirect_url": f"https://fake.pesapal.local/iframe?OrderTrackingId={tracking_id}",
+            "error": None,
+            "status": "200",
+        }
+
+    def transaction_status(self, tracking_id):
+        with self.lock:
+            order = self.orders.get(tracking_id)
+        if order is None:
+            return 404, {"error": {"code": "not_found", "message": "Order not found"}, "status": "404"}
+        done = time.monotonic() - order["submitted"] >= self.completion_delay
+        description = self.final_status if done else "Pending"
+        return 200, {
+            "payment_status_description": description,
+            "status_code": {"Completed": 1, "Failed": 2, "Cancelled": 3}.get(description, 0),
+            "merchant_reference": order["merchant_reference"],
+            "amount": order["amount"],
+            "currency": order["currency"],
+            "payment_method": "Fake",
+            "error": None,
+            "status": "200",
+        }
+
+    def authorized(self, header):
+        token = (header or "").removeprefix("Bearer ")
+        with self.lock:
+            return token in self.tokens
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def handle_api(self, endpoint, call):
+            with api.lock:
+                api.calls[endpoint] += 1
+            api.delay()
+            if api.should_fail():
+                with api.lock:
+                    api.calls[f"{endpoint}:error"] += 1
+                return self.send_json(503, {"error": {"code": "unavailable", "message": "Injected failure"}})
+            if endpoint != "RequestToken" and not api.authorized(self.headers.get("Authorization")):
+                return self.send_json(401, {"error": {"code": "invalid_token", "message": "Unauthorized"}})
+            self.send_json(*call())
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            if path.endswith("/Auth/RequestToken"):
+                self.read_json()
+                return self.handle_api("RequestToken", api.request_token)
+            if path.endswith("/Transactions/SubmitOrderRequest"):
+                payload = self.read_json()
+                return self.handle_api("SubmitOrderRequest", lambda: api.submit_order(payload))
+            self.send_json(404, {"error": "Unknown endpoint"})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.endswith("/__stats"):
+                with api.lock:
+                    return self.send_json(200, dict(api.calls))
+            if url.path.endswith("/Transactions/GetTransactionStatus"):
+                tracking_id = parse_qs(url.query).get("orderTrackingId", [""])[0]
+                return self.handle_api("GetTransactionStatus", lambda: api.transaction_status(tracking_id))
+            self.send_json(404, {"error": "Unknown endpoint"})
+
+    return Handler
+
+
+def start_server(api, host="127.0.0.1", port=0):
+    """Serve `api` in a background thread; returns the server (see server.server_port)."""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 503")
+    parser.add_argument("--completion-delay", type=float, default=5.0, help="seconds until an order settles")
+    parser.add_argument("--final-status", default="Completed", choices=["Completed", "Failed", "Cancelled"])
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    api = FakePesapal(args.latency, args.jitter, args.error_rate, args.completion_delay, args.final_status, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api))
+    server.daemon_threads = True
+    print(f"Fake Pesapal listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
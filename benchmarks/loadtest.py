@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Load harness for the payment flow: initiate -> status polls -> IPN callback.
+
+    python benchmarks/loadtest.py --base-url http://127.0.0.1:8000 \\
+        --username loadtest --password secret --users 50 --duration 60
+
+Each virtual user repeatedly initiates a payment, polls its status --polls times
+--poll-interval seconds apart and then delivers the IPN callback. Run the app
+against benchmarks/fake_pesapal.py (PESAPAL_BASE_URL) so Pesapal latency and
+errors are controlled; pass --pesapal-url to include its call counts in the report.
+
+Reports p50/p95/p99 latency and requests per second per endpoint.
+--save-baseline stores the report as JSON; --baseline compares against one and exits
+non-zero when p95 latency grows or throughput drops by more than --max-regression.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+
+ENDPOINTS = ("initiate", "status", "callback")
+
+
+def summarize(samples, errors, elapsed):
+    """Per-endpoint latency percentiles (ms), request rate and error counts."""
+    report = {}
+    for endpoint in ENDPOINTS:
+        latencies = sorted(samples.get(endpoint, []))
+        if len(latencies) >= 2:
+            cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+        else:
+            p50 = p95 = p99 = latencies[0] if latencies else 0.0
+        report[endpoint] = {
+            "requests": len(latencies),
+            "errors": errors.get(endpoint, 0),
+            "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(p50 * 1000, 2),
+            "p95_ms": round(p95 * 1000, 2),
+            "p99_ms": round(p99 * 1000, 2),
+        }
+    total = sum(entry["requests"] for entry in report.values())
+    report["total"] = {"requests": total, "rps": round(total / elapsed, 2) if elapsed else 0.0}
+    return report
+
+
+def compare(report, baseline, max_regression):
+    """Return a list of regressions of `report` against `baseline`."""
+    regressions = []
+    for endpoint in ENDPOINTS:
+        now, then = report.get(endpoint), baseline.get(endpoint)
+        if not now or not then or not then["requests"]:
+            continue
+        if then["p95_ms"] and now["p95_ms"] > then["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{endpoint}: p95 {then['p95_ms']}ms -> {now['p95_ms']}ms")
+        if then["rps"] and now["rps"] < then["rps"] * (1 - max_regression):
+            regressions.append(f"{endpoint}: rps {then['rps']} -> {now['rps']}")
+    return regressions
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def timed(self, endpoint, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return None
+        self.samples[endpoint].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[endpoint] += 1
+            return None
+        return response
+
+    async def user_flow(self, client, headers, deadline):
+        api = f"{self.args.base_url}/api/pesapal/pesapal"
+        while time.monotonic() < deadline:
+            response = await self.timed(
+                "initiate",
+                client.post(f"{api}/initiate/", json={"amount": "100.00", "phone_number": "0712345678"}, headers=headers),
+            )
+            order = response.json() if response is not None else {}
+            tracking_id, reference = order.get("order_tracking_id"), order.get("merchant_reference")
+            if not tracking_id:
+                # Back off rather than hammering a failing endpoint in a tight loop.
+                await asyncio.sleep(self.args.poll_interval)
+                continue
+            for _ in range(self.args.polls):
+                await asyncio.sleep(self.args.poll_interval)
+                await self.timed("status", client.get(f"{api}/status/{tracking_id}/"))
+            await self.timed(
+                "callback",
+                client.post(f"{api}/callback/", json={"OrderTrackingId": tracking_id, "OrderMerchantReference": reference}),
+            )
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.args.users * 2)
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits) as client:
+            token = self.args.token
+            if not token:
+                response = await client.post(
+                    f"{self.args.base_url}/api/token/",
+                    json={"username": self.args.username, "password": self.args.password},
+                )
+                response.raise_for_status()
+                token = response.json()["access"]
+            # Access tokens are short-lived; keep runs shorter than ACCESS_TOKEN_LIFETIME.
+            headers = {"Authorization": f"Bearer {token}"}
+
+            started = time.monotonic()
+            deadline = started + self.args.duration
+            await asyncio.gather(*(self.user_flow(client, headers, deadline) for _ in range(self.args.users)))
+            elapsed = time.monotonic() - started
+
+            report = summarize(self.samples, self.errors, elapsed)
+            report["config"] = {
+                key: getattr(self.args, key) for key in ("users", "duration", "polls", "poll_interval")
+            }
+            if self.args.pesapal_url:
+                report["pesapal_calls"] = (await client.get(f"{self.args.pesapal_url}/__stats")).json()
+            return report
+
+
+def print_report(report):
+    print(f"{'endpoint':10s} {'requests':>9s} {'errors':>7s} {'rps':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    for endpoint in ENDPOINTS:
+        entry = report[endpoint]
+        print(
+            f"{endpoint:10s} {entry['requests']:9d} {entry['errors']:7d} {entry['rps']:9.2f} "
+            f"{entry['p50_ms']:9.2f} {entry['p95_ms']:9.2f} {entry['p99_ms']:9.2f}"
+        )
+    print(f"{'total':10s} {report['total']['requests']:9d} {'':7s} {report['total']['rps']:9.2f}")
+    if "pesapal_calls" in report:
+        print(f"Pesapal calls: {report['pesapal_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--token", help="JWT access token (instead of --username/--password)")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--polls", type=int, default=3, help="status polls per payment")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--pesapal-url", help="fake Pesapal URL, to report its call counts")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed fractional regression")
+    args = parser.parse_args()
+    if not args.token and not (args.username and args.password):
+        parser.error("pass --token or --username and --password")
+
+    report = asyncio.run(LoadTest(args).run())
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
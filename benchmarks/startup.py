@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Boot time of the web (gunicorn) and Celery worker entry points.
+
+    python benchmarks/startup.py --runs 10 --save-baseline startup.json
+    python benchmarks/startup.py --runs 10 --baseline startup.json
+
+Starts each entry point --runs times in a fresh interpreter and reports the median and
+best boot time. --save-baseline stores the report as JSON; --baseline compares against
+one and exits non-zero when a median grows by more than --max-regression, or when an
+entry point imports a dependency that should only be loaded on first use.
+Use `python manage.py profile_startup` to see which modules the time goes to.
+"""
+import argparse
+import json
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pesapal.startup import ENTRY_POINTS, loaded_lazy_modules, run_entry_point  # noqa: E402
+
+
+def measure(entry, runs):
+    timings = [run_entry_point(entry)[0] for _ in range(runs)]
+    return {
+        "median_s": round(statistics.median(timings), 3),
+        "best_s": round(min(timings), 3),
+        "runs": runs,
+        "lazy_modules_loaded": loaded_lazy_modules(entry),
+    }
+
+
+def compare(report, baseline, max_regression):
+    """Return a list of regressions of `report` against `baseline`."""
+    regressions = []
+    for entry, now in report.items():
+        if now["lazy_modules_loaded"]:
+            regressions.append(f"{entry}: imports {', '.join(now['lazy_modules_loaded'])} at boot")
+        then = baseline.get(entry)
+        if then and now["median_s"] > then["median_s"] * (1 + max_regression):
+            regressions.append(f"{entry}: median boot {then['median_s']}s -> {now['median_s']}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", choices=sorted(ENTRY_POINTS), action="append")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed fractional regression")
+    args = parser.parse_args()
+
+    report = {entry: measure(entry, args.runs) for entry in args.entry or sorted(ENTRY_POINTS)}
+    for entry, result in report.items():
+        lazy = ", ".join(result["lazy_modules_loaded"]) or "none"
+        print(f"{entry:8} median {result['median_s']:.3f}s  best {result['best_s']:.3f}s  "
+              f"({result['runs']} runs; lazy dependencies loaded: {lazy})")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    regressions = compare(report, {}, args.max_regression)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmark the hot PesapalTransaction lookups before and after the lookup indexes
+(migration pesapal 0002) on a throwaway SQLite database.
+
+    python benchmarks/transaction_lookups.py --rows 1000000
+
+Loads --rows transactions at migration 0001, times each query, migrates to 0002
+and times them again. Query plans are printed so the index use can be checked.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "safari.settings")
+
+STATUSES = ["COMPLETED"] * 90 + ["FAILED"] * 5 + ["CANCELLED"] * 3 + ["PENDING"] * 2
+
+
+def load_rows(connection, rows, users):
+    from django.db import transaction
+    from django.utils import timezone
+
+    now = timezone.now()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO auth_user (password, is_superuser, username, first_name, last_name, email, "
+            "is_staff, is_active, date_joined) VALUES ('', 0, %s, '', '', '', 0, 1, %s)",
+            [(f"user{i}", now) for i in range(users)],
+        )
+        batch = []
+        for i in range(rows):
+            created = now - timedelta(seconds=random.randint(0, 2 * 365 * 24 * 3600))
+            batch.append((
+                str(uuid.uuid4()), f"track-{i}", "100.00", "bench@example.com",
+                random.choice(STATUSES), "Payment for goods", created, created, random.randint(1, users),
+            ))
+            if len(batch) == 10_000:
+                _insert(cursor, batch)
+                batch = []
+        if batch:
+            _insert(cursor, batch)
+
+
+def _insert(cursor, batch):
+    cursor.executemany(
+        "INSERT INTO pesapal_pesapaltransaction (order_id, order_tracking_id, amount, email, status, "
+        "description, created_at, updated_at, user_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        batch,
+    )
+
+
+def queries(rows, users):
+    from django.utils import timezone
+    from pesapal.models import PesapalTransaction
+
+    threshold = timezone.now() - timedelta(minutes=15)
+    return {
+        "status lookup by order_tracking_id": lambda: list(
+            PesapalTransaction.objects.filter(order_tracking_id=f"track-{random.randrange(rows)}")
+        ),
+        "reconciliation chunk (PENDING, created_at)": lambda: list(
+            PesapalTransaction.objects.filter(
+                status="PENDING", created_at__lt=threshold, order_tracking_id__isnull=False
+            ).order_by("created_at", "pk").values_list("pk", "order_tracking_id", "created_at")[:500]
+        ),
+        "user history (user, created_at)": lambda: list(
+            PesapalTransaction.objects.filter(user_id=random.randint(1, users)).order_by("-created_at")[:20]
+        ),
+    }
+
+
+def query_plan(connection, query):
+    captured = []
+
+    def capture(execute, sql, params, many, context):
+        captured.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(capture):
+        query()
+    sql, params = captured[0]
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return "; ".join(row[-1] for row in cursor.fetchall())
+
+
+def run(connection, rows, users, iterations):
+    connection.cursor().execute("ANALYZE")
+    results = {}
+    for name, query in queries(rows, users).items():
+        query()  # warm up
+        started = time.perf_counter()
+        for _ in range(iterations):
+            query()
+        results[name] = (time.perf_counter() - started) / iterations * 1000
+        print(f"  {name:45s} {results[name]:10.3f} ms   plan: {query_plan(connection, query)}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    from django.conf import settings
+
+    db_file = Path(tempfile.mkdtemp()) / "bench.sqlite3"
+    settings.DATABASES["default"]["NAME"] = str(db_file)
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.db import connection
+
+    call_command("migrate", verbosity=0)
+    call_command("migrate", "pesapal", "0001", verbosity=0)
+    # Bulk loading only; the benchmark database is thrown away afterwards.
+    connection.cursor().execute("PRAGMA synchronous = OFF")
+
+    started = time.perf_counter()
+    load_rows(connection, args.rows, args.users)
+    print(f"Loaded {args.rows} transactions in {time.perf_counter() - started:.1f}s")
+
+    print("Before (0001, no lookup indexes):")
+    before = run(connection, args.rows, args.users, args.iterations)
+
+    started = time.perf_counter()
+    call_command("migrate", "pesapal", "0002", verbosity=0)
+    print(f"Applied 0002 in {time.perf_counter() - started:.1f}s")
+
+    print("After (0002):")
+    after = run(connection, args.rows, args.users, args.iterations)
+
+    print("Speedup:")
+    for name in before:
+        print(f"  {name:45s} {before[name] / after[name]:10.1f}x")
+    db_file.unlink()
+
+
+if __name__ == "__main__":
+    main()
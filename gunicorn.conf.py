@@ -0,0 +1,11 @@
+# Loaded automatically by gunicorn when started from the project root.
+
+
+def child_exit(server, worker):
+    # Drop the Prometheus samples of exited workers (PROMETHEUS_MULTIPROC_DIR mode).
+    import os
+
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -6,4 +6,6 @@ class PesapalConfig(AppConfig):
     name = "pesapal"
 
     def ready(self):
+        import pesapal.metrics
+        import pesapal.profiling
         import pesapal.signals
@@ -0,0 +1,136 @@
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from .models import ArchivedTransaction, PaymentConfirmation, PesapalTransaction
+
+logger = logging.getLogger(__name__)
+
+# Archival of old terminal transactions, keeping PesapalTransaction small.
+#
+# Rows that have been COMPLETED, FAILED, CANCELLED or EXPIRED for longer than the configured age
+# are moved in pk-ordered chunks, each in its own database transaction, either into
+# ArchivedTransaction or out to gzipped NDJSON files. The last archived pk is kept in
+# the cache as a checkpoint, so a run cut short by its time budget is resumed by the
+# next one; a run that reaches the end clears it.
+
+ARCHIVE_LOCK_KEY = "pesapal:archive_transactions:lock"
+ARCHIVE_CHECKPOINT_KEY = "pesapal:archive_transactions:checkpoint"
+
+ARCHIVED_STATUSES = PesapalTransaction.TERMINAL_STATUSES | {PesapalTransaction.EXPIRED_STATUS}
+
+ARCHIVED_FIELDS = [
+    "id",
+    "user_id",
+    "order_id",
+    "order_tracking_id",
+    "amount",
+    "email",
+    "phone_number",
+    "status",
+    "description",
+    "created_at",
+    "updated_at",
+]
+
+
+def archivable_transactions(older_than_days):
+    """Terminal and expired transactions last updated more than `older_than_days` days ago."""
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    # Confirmation emails still to be sent need their transaction.
+    unsent = PaymentConfirmation.objects.filter(
+        sent_at__isnull=True, attempts__lt=settings.PESAPAL_EMAIL_MAX_ATTEMPTS
+    ).values("transaction_id")
+    return PesapalTransaction.objects.filter(
+        status__in=ARCHIVED_STATUSES, updated_at__lt=cutoff
+    ).exclude(pk__in=unsent)
+
+
+def _export_chunk(rows, export_dir):
+    path = os.path.join(export_dir, f"pesapal-transactions-{rows[0]['id']}-{rows[-1]['id']}.ndjson.gz")
+    # Written under a temporary name, so a file only appears complete.
+    with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def archive_transactions(older_than_days=None, chunk_size=None, time_budget=None, export_dir=None):
+    """
+    Move archivable transactions out of PesapalTransaction; returns run statistics.
+
+    With `export_dir` the rows are written to compressed files there instead of the
+    archive table. Callers are expected to hold ARCHIVE_LOCK_KEY.
+    """
+    older_than_days = settings.PESAPAL_ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    chunk_size = chunk_size or settings.PESAPAL_ARCHIVE_CHUNK_SIZE
+    time_budget = settings.PESAPAL_ARCHIVE_TIME_BUDGET if time_budget is None else time_budget
+
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+    queryset = archivable_transactions(older_than_days).order_by("pk").values(*ARCHIVED_FIELDS)
+    last_pk = cache.get(ARCHIVE_CHECKPOINT_KEY, 0)
+    stats = {"archived": 0, "chunks": 0, "conflicts": 0, "files": [], "complete": True}
+    started = time.monotonic()
+
+    while True:
+        if time.monotonic() - started >= time_budget:
+            stats["complete"] = False
+            logger.warning(f"Archival time budget exhausted after pk {last_pk}; resuming from there next run.")
+            break
+        with db_transaction.atomic():
+            # Locked until the chunk is moved, so a late IPN settling an EXPIRED row waits
+            # instead of being lost with a copy of the old row.
+            rows = list(queryset.filter(pk__gt=last_pk).select_for_update()[:chunk_size])
+            if not rows:
+                break
+            pks = [row["id"] for row in rows]
+            if export_dir:
+                stats["files"].append(_export_chunk(rows, export_dir))
+            else:
+                ArchivedTransaction.objects.bulk_create(
+                    [ArchivedTransaction(**row) for row in rows], ignore_conflicts=True
+                )
+                # Rows skipped as conflicts (e.g. an order_id already in the archive under
+                # another pk) were not archived and must stay in the hot table.
+                order_ids = {row["id"]: row["order_id"] for row in rows}
+                archived = ArchivedTransaction.objects.filter(pk__in=pks).values_list("pk", "order_id")
+                pks = [pk for pk, order_id in archived if order_ids[pk] == order_id]
+                if len(pks) < len(rows):
+                    stats["conflicts"] += len(rows) - len(pks)
+                    logger.error(
+                        f"{len(rows) - len(pks)} transactions up to pk {rows[-1]['id']} conflict "
+                        f"with archived rows; left in place."
+                    )
+            # The archivable filter again: only rows still as they were read are removed.
+            _, deleted = archivable_transactions(older_than_days).filter(pk__in=pks).delete()
+            if deleted.get(PesapalTransaction._meta.label, 0) < len(pks):
+                # Changed since the read (only possible where select_for_update is a no-op,
+                # e.g. SQLite): keep the live row and drop its stale archive copy.
+                live = set(PesapalTransaction.objects.filter(pk__in=pks).values_list("pk", flat=True))
+                if not export_dir:
+                    ArchivedTransaction.objects.filter(pk__in=live).delete()
+                pks = [pk for pk in pks if pk not in live]
+        last_pk = rows[-1]["id"]
+        cache.set(ARCHIVE_CHECKPOINT_KEY, last_pk, timeout=None)
+        stats["archived"] += len(pks)
+        stats["chunks"] += 1
+
+    if stats["complete"]:
+        cache.delete(ARCHIVE_CHECKPOINT_KEY)
+    stats["duration"] = round(time.monotonic() - started, 3)
+    logger.info(
+        f"Archived {stats['archived']} transactions in {stats['chunks']} chunks "
+        f"({'files in ' + export_dir if export_dir else 'archive table'})."
+    )
+    return stats
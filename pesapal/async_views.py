@@ -0,0 +1,341 @@
+import asyncio
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework import exceptions, status
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from utils.pesapal import CircuitOpenError, RateLimited, asubmit_order, acheck_transaction_status
+from .authentication import ClaimsJWTAuthentication
+from .events import hub
+from .idempotency import (
+    IDEMPOTENCY_HEADER,
+    MAX_KEY_LENGTH,
+    REPLAYED_HEADERS,
+    arun_idempotent,
+    request_fingerprint,
+)
+from .metrics import record_ipn_received
+from .models import PesapalTransaction
+from .services import (
+    PAYMENTS_UNAVAILABLE_MESSAGE,
+    apply_batch_outcomes,
+    build_order_payload,
+    ipn_terminal_key,
+    new_batch_transactions,
+    parse_batch_payments,
+)
+from .status_cache import aget_transaction_status, status_payload
+from .tasks import queue_ipn_notification
+
+# Async counterparts of the views in views.py, for running under an ASGI server
+# (see safari/asgi.py). Upstream Pesapal calls are awaited on the event loop, so a
+# single process can keep many of them in flight. Enable with PESAPAL_ASYNC_VIEWS.
+
+
+class AsyncAPIView(View):
+    """
+    Minimal async stand-in for DRF's APIView (which cannot run async handlers).
+
+    Parses the request body and runs the configured DRF authentication and
+    permission classes; authentication may hit the database, so it runs in a thread.
+    """
+
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES
+    permission_classes = []
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Same as APIView: authentication classes take care of CSRF where needed.
+        view.csrf_exempt = True
+        return view
+
+    def check_permissions(self, request):
+        request.user  # Triggers authentication.
+        for permission in [permission() for permission in self.permission_classes]:
+            if not permission.has_permission(request, self):
+                if request.authenticators and not request.successful_authenticator:
+                    raise exceptions.NotAuthenticated()
+                raise exceptions.PermissionDenied()
+
+    def handle_exception(self, exc):
+        data = exc.detail if isinstance(exc.detail, (dict, list)) else {"detail": exc.detail}
+        response = JsonResponse(data, status=exc.status_code, safe=False)
+        if exc.status_code == status.HTTP_401_UNAUTHORIZED and self.authentication_classes:
+            header = self.authentication_classes[0]().authenticate_header(None)
+            if header:
+                response["WWW-Authenticate"] = header
+        return response
+
+    async def dispatch(self, request, *args, **kwargs):
+        drf_request = Request(
+            request,
+            parsers=[parser() for parser in self.parser_classes],
+            authenticators=[auth() for auth in self.authentication_classes],
+        )
+        try:
+            await sync_to_async(self.check_permissions)(drf_request)
+            handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            response = handler(drf_request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        except exceptions.APIException as exc:
+            return self.handle_exception(exc)
+
+
+class AsyncPesapalInitPaymentView(AsyncAPIView):
+    """
+    Receive total amount + user details from frontend,
+    and initiate payment with Pesapal. Supports Idempotency-Key like the sync view.
+    """
+
+    permission_classes = [IsAuthenticated]
+    # User lookup (JWT), INSERT, tracking ID UPDATE.
+    query_budget = 3
+
+    async def post(self, request):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return await self.initiate(request)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return JsonResponse(
+                {"error": f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        fingerprint = request_fingerprint(
+            {"amount": request.data.get("amount"), "phone_number": request.data.get("phone_number", "")}
+        )
+
+        async def handler():
+            response = await self.initiate(request)
+            headers = {name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)}
+            return response.status_code, json.loads(response.content), headers
+
+        status_code, body, headers = await arun_idempotent(request.user.pk, key, fingerprint, handler)
+        return JsonResponse(body, status=status_code, headers=headers)
+
+    async def initiate(self, request):
+        user = request.user
+        amount = request.data.get("amount")
+        phone_number = request.data.get("phone_number", "")
+
+        if not amount:
+            return JsonResponse(
+                {"error": "Amount is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        order_id = str(uuid.uuid4())
+
+        try:
+            transaction = await PesapalTransaction.objects.acreate(
+                user=user,
+                order_id=order_id,
+                amount=amount,
+                email=user.email,
+                phone_number=phone_number,
+                description="Payment for goods",
+            )
+        except Exception as e:
+            return JsonResponse(
+                {"error": f"Failed to create transaction record: {str(e)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        payload = build_order_payload(order_id, amount, user, phone_number)
+
+        try:
+            response_data = await asubmit_order(payload)
+
+            if response_data.get("order_tracking_id"):
+                transaction.order_tracking_id = response_data.get("order_tracking_id")
+                await transaction.asave(update_fields=["order_tracking_id", "updated_at"])
+
+            return JsonResponse(response_data, status=status.HTTP_200_OK)
+        except (CircuitOpenError, RateLimited) as e:
+            transaction.status = "FAILED"
+            await transaction.asave(update_fields=["status", "updated_at"])
+            return JsonResponse(
+                {"error": PAYMENTS_UNAVAILABLE_MESSAGE},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        except Exception as e:
+            transaction.status = "FAILED"
+            await transaction.asave(update_fields=["status", "updated_at"])
+            return JsonResponse(
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class AsyncPesapalBatchInitPaymentView(AsyncAPIView):
+    """
+    Initiate several Pesapal payments at once; see PesapalBatchInitPaymentView. The
+    submissions run on the event loop, PESAPAL_BATCH_CONCURRENCY at a time.
+    """
+
+    permission_classes = [IsAuthenticated]
+    # User lookup (JWT), bulk INSERT, bulk UPDATE.
+    query_budget = 3
+
+    async def post(self, request):
+        payments, error = parse_batch_payments(request.data)
+        if error:
+            return JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = request.user
+        transactions = await PesapalTransaction.objects.abulk_create(new_batch_transactions(user, payments))
+        semaphore = asyncio.Semaphore(settings.PESAPAL_BATCH_CONCURRENCY)
+
+        async def submit(transaction):
+            payload = build_order_payload(transaction.order_id, transaction.amount, user, transaction.phone_number)
+            async with semaphore:
+                try:
+                    return await asubmit_order(payload), None
+                except Exception as e:
+                    return None, e
+
+        outcomes = await asyncio.gather(*(submit(transaction) for transaction in transactions))
+
+        results, status_code, headers = apply_batch_outcomes(transactions, outcomes)
+        await PesapalTransaction.objects.abulk_update(transactions, ["order_tracking_id", "status", "updated_at"])
+        return JsonResponse({"results": results}, status=status_code, headers=headers)
+
+
+class AsyncPesapalCallbackView(AsyncAPIView):
+    """
+    Handle IPN (Instant Payment Notification) callback from Pesapal.
+    This view is called by Pesapal to notify of a transaction status change.
+    Notifications are queued for process_ipn_notifications (see PesapalCallbackView).
+    """
+
+    # Transaction lookup, notification INSERT.
+    query_budget = 2
+
+    async def post(self, request):
+        data = request.data
+        order_tracking_id = data.get("OrderTrackingId")
+        merchant_reference = data.get("OrderMerchantReference")
+
+        if not order_tracking_id or not merchant_reference:
+            return JsonResponse(
+                {"error": "Missing OrderTrackingId or OrderMerchantReference"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if await cache.aget(ipn_terminal_key(order_tracking_id)):
+            record_ipn_received("settled")
+            return JsonResponse({"message": "Callback processed"}, status=status.HTTP_200_OK)
+
+        try:
+            transaction_status = await (
+                PesapalTransaction.objects.filter(order_id=merchant_reference, order_tracking_id=order_tracking_id)
+                .values_list("status", flat=True)
+                .afirst()
+            )
+            if transaction_status is None:
+                record_ipn_received("unknown_order")
+                return JsonResponse(
+                    {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+                )
+            if transaction_status in PesapalTransaction.TERMINAL_STATUSES:
+                await cache.aset(ipn_terminal_key(order_tracking_id), transaction_status,
+                                 timeout=settings.PESAPAL_IPN_TERMINAL_CACHE_TIMEOUT)
+                record_ipn_received("settled")
+                return JsonResponse({"message": "Callback processed"}, status=status.HTTP_200_OK)
+
+            await sync_to_async(queue_ipn_notification)(
+                order_tracking_id, merchant_reference, data.get("OrderNotificationType") or ""
+            )
+            return JsonResponse({"message": "Callback received"}, status=status.HTTP_200_OK)
+        except Exception as e:
+            return JsonResponse(
+                {"error": f"An error occurred: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+
+class AsyncPesapalCheckStatusView(AsyncAPIView):
+    """
+    Allows the frontend to check the transaction status from our system.
+    """
+
+    authentication_classes = [ClaimsJWTAuthentication, SessionAuthentication]
+    # Transaction lookup on a cache miss, its re-read on the primary (with replicas) and
+    # status UPDATE when Pesapal reports a change, confirmation outbox INSERT when that
+    # change completes the payment.
+    query_budget = 4
+
+    async def get(self, request, order_tracking_id):
+        try:
+            response_data = await aget_transaction_status(order_tracking_id, acheck_transaction_status)
+            return JsonResponse(response_data, status=status.HTTP_200_OK)
+        except PesapalTransaction.DoesNotExist:
+            return JsonResponse(
+                {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        except Exception as e:
+            return JsonResponse(
+                {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class PesapalStatusStreamView(AsyncAPIView):
+    """
+    Server-Sent Events stream that pushes one `status` event when the transaction
+    reaches a terminal state, then closes. Requires an ASGI server.
+    """
+
+    # Transaction lookup when the stream opens.
+    query_budget = 1
+
+    async def get(self, request, order_tracking_id):
+        # Subscribe before reading the current state so a change in between is not missed.
+        queue = hub.subscribe(order_tracking_id)
+        try:
+            transaction = await PesapalTransaction.objects.aget(order_tracking_id=order_tracking_id)
+        except PesapalTransaction.DoesNotExist:
+            hub.unsubscribe(order_tracking_id, queue)
+            return JsonResponse(
+                {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        if transaction.status in PesapalTransaction.TERMINAL_STATUSES:
+            queue.put_nowait(status_payload(transaction))
+
+        response = StreamingHttpResponse(
+            self.stream(order_tracking_id, queue), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # Don't let nginx buffer the stream.
+        return response
+
+    async def stream(self, order_tracking_id, queue):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.PESAPAL_STATUS_STREAM_TIMEOUT
+        try:
+            yield f"retry: {settings.PESAPAL_STATUS_STREAM_HEARTBEAT * 1000}\n\n"
+            while loop.time() < deadline:
+                try:
+                    event = await asyncio.wait_for(
+                        queue.get(),
+                        timeout=min(settings.PESAPAL_STATUS_STREAM_HEARTBEAT, deadline - loop.time()),
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: status\ndata: {json.dumps(event)}\n\n"
+                return
+        finally:
+            hub.unsubscribe(order_tracking_id, queue)
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+# JWT authentication without a user query per request.
+#
+# CachedJWTAuthentication keeps resolved users in the cache for AUTH_USER_CACHE_TIMEOUT
+# seconds; saving or deleting a user drops its entry (see pesapal.signals), so
+# deactivations and password changes apply to the next request. Views that only need the
+# token's claims use ClaimsJWTAuthentication, which builds the user from the token alone.
+
+
+def auth_user_cache_key(user_id):
+    return f"pesapal:auth:user:{user_id}"
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(auth_user_cache_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves users through the cache."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        key = auth_user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            # Checks the user exists and is active; only such users are cached.
+            user = super().get_user(validated_token)
+            cache.set(key, user, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+        elif api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+            api_settings.REVOKE_TOKEN_CLAIM
+        ) != get_md5_hash_password(user.password):
+            # A token issued before the password change that refreshed the cached user.
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return user
+
+
+class ClaimsJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    Authenticates from the token alone, with a TokenUser carrying the claims (id,
+    is_staff...) instead of a User. For views that need no more than the user's id;
+    a deactivated user keeps access until their access token expires.
+    """
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from .models import PesapalTransaction
+
+logger = logging.getLogger(__name__)
+
+STATUS_EVENTS_CHANNEL = "pesapal:status-events"
+
+# Terminal status changes are published on a Redis pub/sub channel, so a change made
+# by any web or Celery process reaches the streams held open by every ASGI process.
+# Each ASGI process keeps a single subscription (StatusEventHub) and hands events to
+# the streams waiting on that order, so idle streams cost one queue each.
+# Without PESAPAL_EVENTS_REDIS_URL events only reach streams in the same process,
+# which is enough for development and tests.
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def _redis_client():
+    global _redis
+    if _redis is None:
+        import redis
+
+        with _redis_lock:
+            if _redis is None:
+                _redis = redis.Redis.from_url(settings.PESAPAL_EVENTS_REDIS_URL)
+    return _redis
+
+
+def publish_status_event(event):
+    """Publish a status event ({"order_tracking_id", "status", ...}) right away."""
+    if settings.PESAPAL_EVENTS_REDIS_URL:
+        import redis
+
+        try:
+            _redis_client().publish(STATUS_EVENTS_CHANNEL, json.dumps(event))
+        except redis.RedisError as e:
+            # Streams fall back to their timeout; clients can still poll the status view.
+            logger.error(f"Failed to publish status event for {event['order_tracking_id']}: {e}")
+    else:
+        hub.dispatch_threadsafe(event)
+
+
+def publish_status_events(events):
+    """Publish status events once the current database transaction commits."""
+    for event in events:
+        if event["order_tracking_id"] and event["status"] in PesapalTransaction.TERMINAL_STATUSES:
+            db_transaction.on_commit(partial(publish_status_event, event))
+
+
+class StatusEventHub:
+    """Hands published status events to the streams waiting in this process."""
+
+    def __init__(self):
+        self._waiters = defaultdict(set)
+        self._loop = None
+        self._listener = None
+
+    def subscribe(self, order_tracking_id):
+        """Return a queue that receives events for the order; call from the event loop."""
+        self._loop = asyncio.get_running_loop()
+        if settings.PESAPAL_EVENTS_REDIS_URL and (self._listener is None or self._listener.done()):
+            self._listener = self._loop.create_task(self._listen())
+        queue = asyncio.Queue()
+        self._waiters[order_tracking_id].add(queue)
+        return queue
+
+    def unsubscribe(self, order_tracking_id, queue):
+        waiters = self._waiters.get(order_tracking_id)
+        if waiters is not None:
+            waiters.discard(queue)
+            if not waiters:
+                del self._waiters[order_tracking_id]
+
+    def connections(self):
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def dispatch(self, event):
+        for queue in self._waiters.get(event["order_tracking_id"], ()):
+            queue.put_nowait(event)
+
+    def dispatch_threadsafe(self, event):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.dispatch, event)
+
+    async def _listen(self):
+        import redis.asyncio
+
+        while True:
+            client = redis.asyncio.Redis.from_url(settings.PESAPAL_EVENTS_REDIS_URL)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(STATUS_EVENTS_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.dispatch(json.loads(message["data"]))
+            except redis.RedisError as e:
+                logger.error(f"Status event subscription lost ({e}); reconnecting.")
+                await asyncio.sleep(1)
+            finally:
+                await client.aclose()
+
+
+hub = StatusEventHub()
@@ -0,0 +1,120 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from safari.db import use_replica
+from .models import PesapalTransaction
+
+# Streaming export of PesapalTransaction for finance reconciliation.
+#
+# Rows are read in pk-ordered keyset pages of PESAPAL_EXPORT_CHUNK_SIZE and rendered as
+# CSV or NDJSON one page at a time, optionally through an incremental gzip compressor,
+# so memory use does not depend on the number of rows exported. Used by the staff export
+# endpoint (views.TransactionExportView) and the export_transactions command.
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+EXPORT_FIELDS = [
+    "id",
+    "user_id",
+    "order_id",
+    "order_tracking_id",
+    "amount",
+    "email",
+    "phone_number",
+    "status",
+    "description",
+    "created_at",
+    "updated_at",
+]
+
+
+def parse_export_bound(value, end=False):
+    """
+    Parse a date or datetime bound of the export range; None if invalid.
+
+    A plain date covers the whole day: as the end of the range it means up to the end
+    of that day.
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            return None
+        moment = datetime.combine(day + timedelta(days=1) if end else day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def export_queryset(start=None, end=None, statuses=None):
+    """Transactions created in [start, end) with one of `statuses` (all when empty)."""
+    queryset = PesapalTransaction.objects.all()
+    if start is not None:
+        queryset = queryset.filter(created_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(created_at__lt=end)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    return queryset
+
+
+def iter_export_rows(queryset, chunk_size=None):
+    """Yield the rows of `queryset` as dicts, one keyset page in memory at a time."""
+    chunk_size = chunk_size or settings.PESAPAL_EXPORT_CHUNK_SIZE
+    queryset = queryset.order_by("pk").values(*EXPORT_FIELDS)
+    last_pk = 0
+    while True:
+        with use_replica():
+            rows = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1]["id"]
+
+
+def render_export(pages, export_format):
+    """Render pages of rows as CSV or NDJSON; yields one string per page."""
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        yield buffer.getvalue()
+        for rows in pages:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+    else:
+        for rows in pages:
+            yield "".join(json.dumps(row, cls=DjangoJSONEncoder) + "\n" for row in rows)
+
+
+def gzip_export(chunks):
+    """Compress a stream of strings into a gzip stream as it goes."""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(start=None, end=None, statuses=None, export_format="csv", compress=False, chunk_size=None):
+    """Stream the selected transactions as encoded CSV/NDJSON (gzipped if `compress`)."""
+    chunks = render_export(iter_export_rows(export_queryset(start, end, statuses), chunk_size), export_format)
+    if compress:
+        return gzip_export(chunks)
+    return (chunk.encode("utf-8") for chunk in chunks)
+
+
+def export_filename(export_format, compress=False):
+    name = f"pesapal-transactions-{timezone.now():%Y%m%d-%H%M%S}.{export_format}"
+    return f"{name}.gz" if compress else name
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Idempotency-Key support for the initiate views.
+#
+# The first request with a given key (per user) runs and its response is stored in the
+# cache for PESAPAL_IDEMPOTENCY_TTL seconds; repeats get that response back without
+# touching the database or Pesapal. While the first request is running, repeats wait
+# up to PESAPAL_IDEMPOTENCY_WAIT seconds for its response, then get 409. Server errors
+# (5xx) are not stored, so a retry after an outage submits the order again.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# Response headers stored and replayed along with the body.
+REPLAYED_HEADERS = ("Retry-After",)
+MAX_KEY_LENGTH = 255
+
+KEY_REUSED_MESSAGE = "This Idempotency-Key was already used with a different request."
+IN_PROGRESS_MESSAGE = "A request with this Idempotency-Key is still in progress."
+
+
+def _store_key(user_id, key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return f"pesapal:idempotency:{user_id}:{digest}"
+
+
+def _lock_key(user_id, key):
+    return f"{_store_key(user_id, key)}:lock"
+
+
+def request_fingerprint(data):
+    """Fingerprint of the request fields that determine the response."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _replay(stored, fingerprint):
+    if stored["fingerprint"] != fingerprint:
+        return 422, {"error": KEY_REUSED_MESSAGE}, {}
+    return stored["status"], stored["body"], {**stored["headers"], REPLAYED_HEADER: "true"}
+
+
+def _record(status_code, body, headers, fingerprint):
+    return {"fingerprint": fingerprint, "status": status_code, "body": body, "headers": headers}
+
+
+def run_idempotent(user_id, key, fingerprint, handler):
+    """
+    Run `handler()` at most once per (user, key); returns (status, body, headers).
+
+    `handler` returns the same triple. Callers validate the key first.
+    """
+    store_key, lock_key = _store_key(user_id, key), _lock_key(user_id, key)
+    stored = cache.get(store_key)
+    if stored is not None:
+        return _replay(stored, fingerprint)
+
+    if not cache.add(lock_key, True, timeout=settings.PESAPAL_IDEMPOTENCY_LOCK_TIMEOUT):
+        deadline = time.monotonic() + settings.PESAPAL_IDEMPOTENCY_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            stored = cache.get(store_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+        return 409, {"error": IN_PROGRESS_MESSAGE}, {"Retry-After": "1"}
+
+    try:
+        # The original may have stored its response and released the lock since the
+        # first read.
+        stored = cache.get(store_key)
+        if stored is not None:
+            return _replay(stored, fingerprint)
+        status_code, body, headers = handler()
+        if status_code < 500:
+            cache.set(store_key, _record(status_code, body, headers, fingerprint),
+                      timeout=settings.PESAPAL_IDEMPOTENCY_TTL)
+        return status_code, body, headers
+    finally:
+        cache.delete(lock_key)
+
+
+async def arun_idempotent(user_id, key, fingerprint, handler):
+    """Async version of run_idempotent(); `handler` is a coroutine function."""
+    store_key, lock_key = _store_key(user_id, key), _lock_key(user_id, key)
+    stored = await cache.aget(store_key)
+    if stored is not None:
+        return _replay(stored, fingerprint)
+
+    if not await cache.aadd(lock_key, True, timeout=settings.PESAPAL_IDEMPOTENCY_LOCK_TIMEOUT):
+        deadline = time.monotonic() + settings.PESAPAL_IDEMPOTENCY_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            stored = await cache.aget(store_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+        return 409, {"error": IN_PROGRESS_MESSAGE}, {"Retry-After": "1"}
+
+    try:
+        stored = await cache.aget(store_key)
+        if stored is not None:
+            return _replay(stored, fingerprint)
+        status_code, body, headers = await handler()
+        if status_code < 500:
+            await cache.aset(store_key, _record(status_code, body, headers, fingerprint),
+                             timeout=settings.PESAPAL_IDEMPOTENCY_TTL)
+        return status_code, body, headers
+    finally:
+        await cache.adelete(lock_key)
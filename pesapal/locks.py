@@ -0,0 +1,35 @@
+import uuid
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+
+# Cache locks of the periodic tasks (reconciliation, confirmation emails, archival).
+#
+# Each holder stores a unique token and only releases the lock while it still holds it:
+# a run that outlives its lock's timeout must not delete the lock of the run that took
+# over. On Redis the check and the delete are one atomic script.
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def acquire_lock(key, timeout):
+    """Take the lock; returns the owner token to release it with, or None if it is held."""
+    token = uuid.uuid4().hex
+    return token if cache.add(key, token, timeout=timeout) else None
+
+
+def release_lock(key, token):
+    """Release the lock if `token` still owns it."""
+    backend = caches["default"]
+    if isinstance(backend, RedisCache):
+        client = backend._cache
+        client.get_client(write=True).eval(
+            RELEASE_SCRIPT, 1, backend.make_and_validate_key(key), client._serializer.dumps(token)
+        )
+    elif cache.get(key) == token:
+        cache.delete(key)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pesapal.archive import ARCHIVE_LOCK_KEY, archive_transactions
+from pesapal.locks import acquire_lock, release_lock
+
+
+class Command(BaseCommand):
+    help = "Move old terminal transactions into the archive table or compressed export files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=int, default=settings.PESAPAL_ARCHIVE_AFTER_DAYS,
+                            help="Archive transactions not updated for this many days.")
+        parser.add_argument("--chunk-size", type=int, default=settings.PESAPAL_ARCHIVE_CHUNK_SIZE,
+                            help="Rows moved per database transaction.")
+        parser.add_argument("--time-budget", type=int, default=settings.PESAPAL_ARCHIVE_TIME_BUDGET,
+                            help="Stop after this many seconds; the next run resumes from the checkpoint.")
+        parser.add_argument("--export-dir", default=settings.PESAPAL_ARCHIVE_EXPORT_DIR or None,
+                            help="Write gzipped NDJSON files here instead of the archive table.")
+
+    def handle(self, *args, **options):
+        token = acquire_lock(ARCHIVE_LOCK_KEY, options["time_budget"] + 60)
+        if token is None:
+            raise CommandError("Another archival run is in progress.")
+        try:
+            stats = archive_transactions(
+                older_than_days=options["older_than_days"],
+                chunk_size=options["chunk_size"],
+                time_budget=options["time_budget"],
+                export_dir=options["export_dir"],
+            )
+        finally:
+            release_lock(ARCHIVE_LOCK_KEY, token)
+
+        self.stdout.write(
+            f"Archived {stats['archived']} transactions in {stats['chunks']} chunks ({stats['duration']}s)."
+        )
+        for path in stats["files"]:
+            self.stdout.write(f"  {path}")
+        if stats["conflicts"]:
+            self.stdout.write(f"{stats['conflicts']} transactions conflict with archived rows and were left in place.")
+        if not stats["complete"]:
+            self.stdout.write("Time budget exhausted; run again to continue from the checkpoint.")
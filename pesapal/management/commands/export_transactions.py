@@ -0,0 +1,54 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pesapal.export import EXPORT_FORMATS, parse_export_bound, stream_export
+from pesapal.models import PesapalTransaction
+
+
+class Command(BaseCommand):
+    help = "Stream transactions as CSV or NDJSON to a file or stdout, for finance reconciliation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="start",
+                            help="Only transactions created from this date or datetime on.")
+        parser.add_argument("--to", dest="end",
+                            help="Only transactions created before this datetime (or up to the end of this date).")
+        parser.add_argument("--status", action="append", default=[],
+                            choices=[choice for choice, _ in PesapalTransaction.STATUS_CHOICES],
+                            help="Only transactions with this status; may be repeated.")
+        parser.add_argument("--format", dest="export_format", choices=EXPORT_FORMATS, default="csv")
+        parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip.")
+        parser.add_argument("--output", "-o", help="File to write; stdout by default.")
+        parser.add_argument("--chunk-size", type=int, default=settings.PESAPAL_EXPORT_CHUNK_SIZE,
+                            help="Rows read per query.")
+
+    def handle(self, *args, **options):
+        if options["gzip"] and not options["output"]:
+            raise CommandError("--gzip needs --output.")
+        bounds = {}
+        for name in ("start", "end"):
+            if options[name]:
+                bounds[name] = parse_export_bound(options[name], end=name == "end")
+                if bounds[name] is None:
+                    raise CommandError(f"Invalid date: {options[name]}")
+
+        chunks = stream_export(
+            bounds.get("start"),
+            bounds.get("end"),
+            options["status"],
+            options["export_format"],
+            options["gzip"],
+            options["chunk_size"],
+        )
+        if options["output"]:
+            # Written under a temporary name, so a file only appears complete.
+            path = options["output"]
+            with open(f"{path}.tmp", "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(f"{path}.tmp", path)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk.decode("utf-8"), ending="")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pesapal.startup import ENTRY_POINTS, by_package, parse_importtime, run_entry_point
+
+
+class Command(BaseCommand):
+    help = "Report the boot time of the web and Celery worker entry points, by imported module."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--entry", choices=sorted(ENTRY_POINTS), action="append",
+                            help="Entry point to profile; may be repeated. All by default.")
+        parser.add_argument("--top", type=int, default=25, help="Number of modules to list.")
+        parser.add_argument("--packages", action="store_true",
+                            help="Group import time by top-level package instead of listing modules.")
+
+    def handle(self, *args, **options):
+        for entry in options["entry"] or sorted(ENTRY_POINTS):
+            try:
+                elapsed, _, stderr = run_entry_point(entry, importtime=True)
+            except RuntimeError as e:
+                raise CommandError(str(e))
+            modules = parse_importtime(stderr)
+            total_us = sum(self_us for _, self_us, _ in modules)
+
+            self.stdout.write(
+                f"{entry}: booted in {elapsed:.2f}s, {len(modules)} modules imported in {total_us / 1e6:.2f}s"
+            )
+            if options["packages"]:
+                self.stdout.write(f"  {'self ms':>9}  package")
+                for package, self_us in by_package(modules)[:options["top"]]:
+                    self.stdout.write(f"  {self_us / 1000:9.1f}  {package}")
+            else:
+                self.stdout.write(f"  {'cumul ms':>9} {'self ms':>9}  module")
+                slowest = sorted(modules, key=lambda module: module[2], reverse=True)[:options["top"]]
+                for name, self_us, cumulative_us in slowest:
+                    self.stdout.write(f"  {cumulative_us / 1000:9.1f} {self_us / 1000:9.1f}  {name}")
+            self.stdout.write("")
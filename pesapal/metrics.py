@@ -0,0 +1,285 @@
+import hmac
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django.db.models import Count, Min
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from safari.db import use_replica
+from .profiling import profile_queries
+
+# Prometheus metrics for Pesapal calls, views and Celery tasks, scraped from /metrics/.
+#
+# Under gunicorn (or Celery prefork) every worker process keeps its own counters. Set
+# PROMETHEUS_MULTIPROC_DIR to an empty directory shared by all processes on the host
+# and the scrape endpoint aggregates the values of every process; see the README for
+# the gunicorn hook that cleans up after exited workers.
+
+UPSTREAM_LATENCY = Histogram(
+    "pesapal_upstream_request_seconds",
+    "Duration of each HTTP attempt against the Pesapal API.",
+    ["endpoint"],
+)
+UPSTREAM_ERRORS = Counter(
+    "pesapal_upstream_errors",
+    "Failed HTTP attempts against the Pesapal API.",
+    ["endpoint", "reason"],
+)
+UPSTREAM_REJECTED = Counter(
+    "pesapal_upstream_rejected",
+    "Pesapal calls rejected without a request because the circuit breaker was open.",
+    ["endpoint"],
+)
+RATE_LIMIT_WAIT = Histogram(
+    "pesapal_rate_limit_wait_seconds",
+    "Time Pesapal calls waited for a rate limiter token, per priority class.",
+    ["priority"],
+    buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+RATE_LIMIT_REJECTED = Counter(
+    "pesapal_rate_limit_rejected",
+    "Pesapal calls given up because no rate limiter token came in time, per priority class.",
+    ["priority"],
+)
+VIEW_LATENCY = Histogram(
+    "pesapal_view_request_seconds",
+    "Time spent producing a response, per view.",
+    ["view", "method", "status"],
+)
+VIEW_QUERIES = Histogram(
+    "pesapal_view_db_queries",
+    "Database queries run per request, per view.",
+    ["view"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+TASK_DURATION = Histogram(
+    "pesapal_task_seconds",
+    "Celery task run time.",
+    ["task", "state"],
+    buckets=(0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 900),
+)
+TASK_QUEUE_WAIT = Histogram(
+    "pesapal_task_queue_wait_seconds",
+    "Time between a Celery task being published (or its ETA) and a worker starting it.",
+    ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+IPN_RECEIVED = Counter(
+    "pesapal_ipn_received",
+    "IPN deliveries received, by how the callback handled them.",
+    ["result"],
+)
+IPN_PROCESSED = Counter(
+    "pesapal_ipn_processed",
+    "Queued IPN notifications processed, by outcome.",
+    ["outcome"],
+)
+IPN_PROCESSING_LAG = Histogram(
+    "pesapal_ipn_processing_lag_seconds",
+    "Time from receiving an IPN notification to processing it.",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+CONFIRMATION_EMAILS = Counter(
+    "pesapal_confirmation_emails",
+    "Payment confirmation emails sent from the outbox, by result.",
+    ["result"],
+)
+
+
+def record_upstream_call(endpoint, duration, error=None):
+    """Record one attempt of a Pesapal call; `error` is a short reason such as "http_503"."""
+    UPSTREAM_LATENCY.labels(endpoint).observe(duration)
+    if error:
+        UPSTREAM_ERRORS.labels(endpoint, error).inc()
+
+
+def record_upstream_rejection(endpoint):
+    UPSTREAM_REJECTED.labels(endpoint).inc()
+
+
+def record_rate_limit_wait(priority, waited):
+    RATE_LIMIT_WAIT.labels(priority).observe(waited)
+
+
+def record_rate_limit_rejection(priority):
+    RATE_LIMIT_REJECTED.labels(priority).inc()
+
+
+class MetricsMiddleware:
+    """Record duration and query count of every request that resolved to a view."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with profile_queries(count_only=True) as profile:
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, profile.count)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with profile_queries(count_only=True) as profile:
+            response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, profile.count)
+        return response
+
+    def _record(self, request, response, duration, queries):
+        match = getattr(request, "resolver_match", None)
+        if match is None:
+            return
+        view = match.view_name
+        VIEW_LATENCY.labels(view, request.method, str(response.status_code)).observe(duration)
+        VIEW_QUERIES.labels(view).observe(queries)
+
+
+# Celery tasks. The publish time travels in a message header, so queue wait is measured
+# by the worker that runs the task.
+
+@before_task_publish.connect(dispatch_uid="pesapal.metrics.task_published")
+def task_published(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+
+@task_prerun.connect(dispatch_uid="pesapal.metrics.task_started")
+def task_started(task=None, **kwargs):
+    request = task.request
+    request.metrics_started = time.perf_counter()
+    published_at = getattr(request, "published_at", None)
+    if published_at is None:
+        return
+    ready_at = published_at
+    if request.eta:
+        eta = request.eta
+        if isinstance(eta, str):
+            eta = parse_datetime(eta)
+        if eta is not None:
+            ready_at = max(ready_at, eta.timestamp())
+    TASK_QUEUE_WAIT.labels(task.name).observe(max(0.0, time.time() - ready_at))
+
+
+@task_postrun.connect(dispatch_uid="pesapal.metrics.task_finished")
+def task_finished(task=None, state=None, **kwargs):
+    started = getattr(task.request, "metrics_started", None)
+    if started is not None:
+        TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+def record_ipn_received(result):
+    IPN_RECEIVED.labels(result).inc()
+
+
+def record_ipn_processed(outcome, lags):
+    IPN_PROCESSED.labels(outcome).inc(len(lags))
+    for lag in lags:
+        IPN_PROCESSING_LAG.observe(lag)
+
+
+def record_confirmation_emails(sent, failed):
+    CONFIRMATION_EMAILS.labels("sent").inc(sent)
+    CONFIRMATION_EMAILS.labels("failed").inc(failed)
+
+
+class PendingTransactionsCollector:
+    """Number and age of PENDING transactions, read at scrape time."""
+
+    def collect(self):
+        from .models import PesapalTransaction
+
+        with use_replica():
+            stats = PesapalTransaction.objects.filter(status="PENDING").aggregate(
+                count=Count("id"), oldest=Min("created_at")
+            )
+        oldest = stats["oldest"]
+        yield GaugeMetricFamily(
+            "pesapal_pending_transactions", "Transactions waiting for a final status.", value=stats["count"]
+        )
+        yield GaugeMetricFamily(
+            "pesapal_pending_oldest_age_seconds",
+            "Age of the oldest PENDING transaction.",
+            value=(timezone.now() - oldest).total_seconds() if oldest else 0,
+        )
+
+
+class IpnQueueCollector:
+    """Size and age of the queue of unprocessed IPN notifications, read at scrape time."""
+
+    def collect(self):
+        from .models import PesapalNotification
+
+        with use_replica():
+            stats = PesapalNotification.objects.filter(processed_at__isnull=True).aggregate(
+                count=Count("id"), oldest=Min("received_at")
+            )
+        oldest = stats["oldest"]
+        yield GaugeMetricFamily(
+            "pesapal_ipn_backlog", "IPN notifications waiting to be processed.", value=stats["count"]
+        )
+        yield GaugeMetricFamily(
+            "pesapal_ipn_backlog_oldest_age_seconds",
+            "Age of the oldest unprocessed IPN notification.",
+            value=(timezone.now() - oldest).total_seconds() if oldest else 0,
+        )
+
+
+class CircuitBreakerCollector:
+    """Whether the Pesapal circuit breaker is rejecting calls, read at scrape time."""
+
+    def collect(self):
+        from utils.pesapal import get_client
+
+        yield GaugeMetricFamily(
+            "pesapal_circuit_open",
+            "1 while the Pesapal circuit breaker rejects calls.",
+            value=int(get_client().breaker.is_open()),
+        )
+
+
+def _may_scrape(request):
+    """A bearer token matching METRICS_TOKEN, or a logged-in staff user."""
+    token = settings.METRICS_TOKEN
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    if token and scheme.lower() == "bearer" and hmac.compare_digest(credentials.encode(), token.encode()):
+        return True
+    user = getattr(request, "user", None)
+    return bool(user and user.is_active and user.is_staff)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, for Prometheus (see METRICS_TOKEN) and staff."""
+    # Checked before the collectors run: a scrape costs DB aggregates and a cache read.
+    if not _may_scrape(request):
+        return HttpResponseForbidden()
+    registry = CollectorRegistry(auto_describe=False)
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(PendingTransactionsCollector())
+    registry.register(IpnQueueCollector())
+    registry.register(CircuitBreakerCollector())
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.18 on 2026-10-17 02:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pesapal', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pesapaltransaction',
+            name='order_tracking_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='pesapaltransaction',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['status', 'created_at'], name='pesapal_pending_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pesapaltransaction',
+            index=models.Index(fields=['user', 'created_at'], name='pesapal_user_created_idx'),
+        ),
+    ]
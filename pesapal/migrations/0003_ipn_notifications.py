@@ -0,0 +1,30 @@
+# Generated by Django 4.2.18 on 2026-10-17 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pesapal', '0002_transaction_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PesapalNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_tracking_id', models.CharField(max_length=100)),
+                ('merchant_reference', models.CharField(max_length=100)),
+                ('notification_type', models.CharField(blank=True, max_length=50)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('outcome', models.CharField(blank=True, choices=[('UPDATED', 'Status updated'), ('UNCHANGED', 'Status unchanged'), ('ALREADY_SETTLED', 'Transaction already settled'), ('UNKNOWN_ORDER', 'Unknown order'), ('FAILED', 'Gave up after repeated errors')], max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['order_tracking_id', 'received_at'], name='pesapal_ipn_order_idx'), models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['received_at'], name='pesapal_ipn_unprocessed_idx')],
+            },
+        ),
+    ]
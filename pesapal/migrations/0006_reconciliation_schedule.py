@@ -0,0 +1,38 @@
+# Generated by Django 4.2.18 on 2026-10-17 03:16
+
+from django.db import migrations, models
+import pesapal.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pesapal', '0005_transaction_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pesapaltransaction',
+            name='check_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pesapaltransaction',
+            name='next_check_at',
+            field=models.DateTimeField(blank=True, default=pesapal.models._first_check_at, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedtransaction',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed'), ('CANCELLED', 'Cancelled'), ('EXPIRED', 'Expired')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='pesapaltransaction',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed'), ('CANCELLED', 'Cancelled'), ('EXPIRED', 'Expired')], default='PENDING', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='pesapaltransaction',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['next_check_at'], name='pesapal_pending_due_idx'),
+        ),
+    ]
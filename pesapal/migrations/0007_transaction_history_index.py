@@ -0,0 +1,22 @@
+# Generated by Django 4.2.18 on 2026-10-17 03:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pesapal', '0006_reconciliation_schedule'),
+    ]
+
+    operations = [
+        # The new index is built before the one it replaces is dropped.
+        migrations.AddIndex(
+            model_name='pesapaltransaction',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='pesapal_user_history_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='pesapaltransaction',
+            name='pesapal_user_created_idx',
+        ),
+    ]
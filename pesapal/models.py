@@ -1,5 +1,13 @@
+from datetime import timedelta
+
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
+
+
+def _first_check_at():
+    # New orders get their first reconciliation check once the IPN has had time to arrive.
+    return timezone.now() + timedelta(seconds=settings.PESAPAL_RECONCILE_FIRST_CHECK)
 
 
 class PesapalTransaction(models.Model):
@@ -8,7 +16,13 @@ class PesapalTransaction(models.Model):
         ("COMPLETED", "Completed"),
         ("FAILED", "Failed"),
         ("CANCELLED", "Cancelled"),
+        ("EXPIRED", "Expired"),
     ]
+    # Statuses Pesapal will not change any more.
+    TERMINAL_STATUSES = frozenset({"COMPLETED", "FAILED", "CANCELLED"})
+    # Still PENDING with Pesapal after PESAPAL_RECONCILE_MAX_AGE. Not terminal: a late
+    # IPN is still processed and can settle the order.
+    EXPIRED_STATUS = "EXPIRED"
 
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -17,7 +31,7 @@ class PesapalTransaction(models.Model):
         blank=True,
     )
     order_id = models.CharField(max_length=100, unique=True)  # UUID from your system
-    order_tracking_id = models.CharField(max_length=100, blank=True, null=True)  # From Pesapal
+    order_tracking_id = models.CharField(max_length=100, unique=True, blank=True, null=True)  # From Pesapal
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     email = models.EmailField()
     phone_number = models.CharField(max_length=20, blank=True, null=True)
@@ -25,6 +39,137 @@ class PesapalTransaction(models.Model):
     description = models.CharField(max_length=255, default="Payment for goods")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Reconciliation schedule of a PENDING order: when it is next checked with Pesapal and
+    # how many checks it has had (see pesapal.tasks.verify_pending_transactions).
+    next_check_at = models.DateTimeField(null=True, blank=True, default=_first_check_at)
+    check_attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Reconciliation scans pending rows by age; only PENDING rows are indexed.
+            models.Index(
+                fields=["status", "created_at"],
+                name="pesapal_pending_created_idx",
+                condition=models.Q(status="PENDING"),
+            ),
+            # A user's transactions, newest first: the keyset order of the history endpoint.
+            models.Index(fields=["user", "-created_at", "-id"], name="pesapal_user_history_idx"),
+            # Pending orders due for a reconciliation check.
+            models.Index(
+                fields=["next_check_at"],
+                name="pesapal_pending_due_idx",
+                condition=models.Q(status="PENDING"),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.order_id} - {self.status}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored status so status changes can be detected on save
+        # without re-reading the row (see pesapal.signals).
+        if "status" in instance.__dict__:
+            instance._loaded_status = instance.status
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or "status" in fields:
+            self._loaded_status = self.status
+
+
+class PesapalNotification(models.Model):
+    """
+    An IPN delivery from Pesapal, stored on receipt and processed by a Celery worker
+    (pesapal.tasks.process_ipn_notifications). Unprocessed rows are the queue.
+    """
+
+    OUTCOME_CHOICES = [
+        ("UPDATED", "Status updated"),
+        ("UNCHANGED", "Status unchanged"),
+        ("ALREADY_SETTLED", "Transaction already settled"),
+        ("UNKNOWN_ORDER", "Unknown order"),
+        ("FAILED", "Gave up after repeated errors"),
+    ]
+
+    order_tracking_id = models.CharField(max_length=100)
+    merchant_reference = models.CharField(max_length=100)
+    notification_type = models.CharField(max_length=50, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=20, choices=OUTCOME_CHOICES, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # An order's notifications in arrival order.
+            models.Index(fields=["order_tracking_id", "received_at"], name="pesapal_ipn_order_idx"),
+            # The queue: unprocessed notifications by age.
+            models.Index(
+                fields=["received_at"],
+                name="pesapal_ipn_unprocessed_idx",
+                condition=models.Q(processed_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.order_tracking_id} @ {self.received_at} - {self.outcome or 'queued'}"
+
+
+class PaymentConfirmation(models.Model):
+    """
+    Outbox of payment confirmation emails. A row is written with the status change that
+    completes the transaction and sent in batches by pesapal.tasks.send_payment_confirmations.
+    """
+
+    transaction = models.OneToOneField(PesapalTransaction, on_delete=models.CASCADE, related_name="confirmation")
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # The outbox: unsent confirmations by when they are due.
+            models.Index(
+                fields=["next_attempt_at"],
+                name="pesapal_confirmation_due_idx",
+                condition=models.Q(sent_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"Confirmation for {self.transaction_id} - {'sent' if self.sent_at else 'pending'}"
+
+
+class ArchivedTransaction(models.Model):
+    """
+    A terminal PesapalTransaction moved out of the hot table by pesapal.archive; keeps
+    the original primary key and field values. Read-only once written.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    order_id = models.CharField(max_length=100, unique=True)
+    order_tracking_id = models.CharField(max_length=100, unique=True, blank=True, null=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    email = models.EmailField()
+    phone_number = models.CharField(max_length=20, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=PesapalTransaction.STATUS_CHOICES)
+    description = models.CharField(max_length=255)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # A user's archived transactions, newest first.
+            models.Index(fields=["user", "created_at"], name="pesapal_archived_user_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.order_id} - {self.status} (archived)"
@@ -0,0 +1,163 @@
+import contextvars
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+# Query profiling and budgets for views and Celery tasks.
+#
+# A wrapper installed on every database connection records each query into the
+# profiles active in the current context (profile_queries() blocks nest, and
+# contextvars follow sync_to_async, so async views are covered). Views declare a
+# `query_budget` class attribute and tasks a `query_budget` task option; requests and
+# task runs that exceed it, or repeat a query, are logged, or raise QueryBudgetExceeded
+# when QUERY_BUDGET_STRICT is set (the budget tests turn it on). Requests and tasks are
+# only profiled when QUERY_BUDGET_ENABLED is on (by default with DEBUG, so in development
+# and the test suite); production does not pay for recording every query.
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryProfile:
+    """
+    Queries run inside a profile_queries() block. A `count_only` profile keeps just the
+    count, for always-on users such as the request metrics.
+    """
+
+    def __init__(self, label=None, count_only=False):
+        self.label = label
+        self.count_only = count_only
+        self.count = 0
+        self.statements = Counter()
+        self.calls = Counter()
+
+    def record(self, sql, params, many):
+        self.count += 1
+        if self.count_only:
+            return
+        self.statements[sql] += 1
+        if not many:
+            self.calls[(sql, repr(params))] += 1
+
+    def duplicates(self):
+        """Queries run more than once with identical parameters, as [(sql, times)]."""
+        return [(sql, n) for (sql, _), n in self.calls.items() if n > 1]
+
+    def repeated(self, threshold):
+        """Statements run at least `threshold` times, whatever the parameters (N+1 suspects)."""
+        return [(sql, n) for sql, n in self.statements.items() if n >= threshold]
+
+
+_profiles = contextvars.ContextVar("query_profiles", default=())
+
+
+def _record_query(execute, sql, params, many, context):
+    for profile in _profiles.get():
+        profile.record(sql, params, many)
+    return execute(sql, params, many, context)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    # insert(0, ...): connection.execute_wrapper() blocks pop the last wrapper on exit.
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+connection_created.connect(install_query_recorder, dispatch_uid="pesapal.profiling.query_recorder")
+
+
+@contextmanager
+def profile_queries(label=None, count_only=False):
+    """Record the queries run in this block (and in sync_to_async calls made from it)."""
+    profile = QueryProfile(label, count_only)
+    token = _profiles.set(_profiles.get() + (profile,))
+    try:
+        yield profile
+    finally:
+        _profiles.reset(token)
+
+
+def check_query_budget(profile, budget=None, repeat_threshold=None):
+    """
+    Log (or raise, when QUERY_BUDGET_STRICT) if the profile is over budget, runs an
+    identical query twice or runs one statement `repeat_threshold` times.
+    """
+    problems = []
+    if budget is not None and profile.count > budget:
+        problems.append(f"{profile.count} queries, budget is {budget}")
+    for sql, times in profile.duplicates():
+        problems.append(f"identical query run {times} times: {sql}")
+    if repeat_threshold:
+        for sql, times in profile.repeated(repeat_threshold):
+            problems.append(f"query run {times} times (N+1?): {sql}")
+    if not problems:
+        return
+    message = f"{profile.label}: " + "; ".join(problems)
+    if settings.QUERY_BUDGET_STRICT:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class QueryBudgetMiddleware:
+    """Profile the queries of every request routed to a view and check its budget."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.QUERY_BUDGET_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with profile_queries() as profile:
+            response = self.get_response(request)
+        self._check(request, profile)
+        return response
+
+    async def __acall__(self, request):
+        with profile_queries() as profile:
+            response = await self.get_response(request)
+        self._check(request, profile)
+        return response
+
+    def _check(self, request, profile):
+        match = getattr(request, "resolver_match", None)
+        if match is None:
+            return
+        profile.label = f"view {match.view_name}"
+        budget = getattr(getattr(match.func, "view_class", None), "query_budget", None)
+        check_query_budget(profile, budget, settings.QUERY_REPEAT_THRESHOLD)
+
+
+@task_prerun.connect(dispatch_uid="pesapal.profiling.task_started")
+def task_started(task=None, **kwargs):
+    if not settings.QUERY_BUDGET_ENABLED:
+        return
+    profile = QueryProfile(f"task {task.name}")
+    task.request.query_profile = profile
+    task.request.query_profile_token = _profiles.set(_profiles.get() + (profile,))
+
+
+@task_postrun.connect(dispatch_uid="pesapal.profiling.task_finished")
+def task_finished(task=None, **kwargs):
+    profile = getattr(task.request, "query_profile", None)
+    if profile is None:
+        return
+    _profiles.reset(task.request.query_profile_token)
+    # Batch tasks repeat their statements once per chunk by design; only budgets and
+    # identical queries are checked for tasks.
+    check_query_budget(profile, getattr(task, "query_budget", None))
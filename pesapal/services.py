@@ -0,0 +1,178 @@
+import base64
+import binascii
+import json
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMessage
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from utils.circuit_breaker import CircuitOpenError
+from utils.rate_limiter import RateLimited
+from .models import PesapalTransaction
+
+# Maps Pesapal's payment_status_description onto our transaction statuses.
+PESAPAL_STATUS_MAPPING = {
+    "Completed": "COMPLETED",
+    "Failed": "FAILED",
+    "Cancelled": "CANCELLED",
+}
+
+# Response of the initiate views while the Pesapal circuit breaker is open.
+PAYMENTS_UNAVAILABLE_MESSAGE = "Payments are temporarily unavailable. Please try again shortly."
+
+
+def map_payment_status(status_data: dict):
+    """Return our status for a GetTransactionStatus response, or None if still pending/unknown."""
+    return PESAPAL_STATUS_MAPPING.get(status_data.get("payment_status_description"))
+
+
+def build_order_payload(order_id, amount, user, phone_number):
+    """Build the SubmitOrderRequest body for a new transaction."""
+    return {
+        "id": order_id,
+        "currency": "KES",
+        "amount": float(amount),
+        "description": "Payment for goods",
+        "callback_url": settings.PESAPAL_CALLBACK_URL,
+        "notification_id": settings.PESAPAL_NOTIFICATION_ID,
+        "billing_address": {
+            "email_address": user.email,
+            "phone_number": phone_number,
+            "country_code": "KE",
+            "first_name": user.first_name or "Guest",
+            "last_name": user.last_name or "User",
+        },
+    }
+
+
+def parse_batch_payments(data):
+    """
+    Validate a batch initiate body, {"payments": [{"amount", "phone_number"}, ...]}.
+
+    Returns (payments, error): the cleaned (amount, phone_number) pairs, or a message.
+    Every item is checked up front since one bad row would fail the whole bulk insert.
+    """
+    payments = data.get("payments") if isinstance(data, dict) else None
+    if not isinstance(payments, list) or not payments:
+        return None, "payments must be a non-empty list"
+    if len(payments) > settings.PESAPAL_BATCH_MAX_SIZE:
+        return None, f"At most {settings.PESAPAL_BATCH_MAX_SIZE} payments can be initiated at once"
+
+    amount_field = PesapalTransaction._meta.get_field("amount")
+    cleaned = []
+    for index, item in enumerate(payments):
+        if not isinstance(item, dict) or not item.get("amount"):
+            return None, f"payments[{index}]: Amount is required"
+        try:
+            amount = amount_field.clean(item["amount"], None)
+        except ValidationError as e:
+            return None, f"payments[{index}]: {' '.join(e.messages)}"
+        phone_number = item.get("phone_number") or ""
+        if not isinstance(phone_number, str) or len(phone_number) > 20:
+            return None, f"payments[{index}]: Invalid phone number"
+        cleaned.append((amount, phone_number))
+    return cleaned, None
+
+
+def new_batch_transactions(user, payments):
+    """Unsaved transactions for the cleaned payments of a batch, ready for bulk_create."""
+    return [
+        PesapalTransaction(
+            user=user,
+            order_id=str(uuid.uuid4()),
+            amount=amount,
+            email=user.email,
+            phone_number=phone_number,
+            description="Payment for goods",
+        )
+        for amount, phone_number in payments
+    ]
+
+
+def apply_batch_outcomes(transactions, outcomes):
+    """
+    Record each (response_data, error) submission outcome on its transaction and build
+    the batch response as (results, status, headers).
+
+    The caller saves the transactions in one bulk_update, which skips the post_save
+    status handlers; these orders have no tracking ID yet, so nothing listens for them.
+    The batch gets a 503 only if every order failed because Pesapal is unavailable.
+    """
+    now = timezone.now()
+    results = []
+    retry_after = []
+    for transaction, (response_data, error) in zip(transactions, outcomes):
+        transaction.updated_at = now
+        if error is None:
+            transaction.order_tracking_id = response_data.get("order_tracking_id")
+            results.append({"order_id": transaction.order_id, "response": response_data})
+            continue
+        transaction.status = "FAILED"
+        if isinstance(error, (CircuitOpenError, RateLimited)):
+            retry_after.append(error.retry_after)
+            results.append({
+                "order_id": transaction.order_id,
+                "error": PAYMENTS_UNAVAILABLE_MESSAGE,
+                "retry_after": error.retry_after,
+            })
+        else:
+            results.append({"order_id": transaction.order_id, "error": str(error)})
+
+    if len(retry_after) == len(transactions):
+        return results, 503, {"Retry-After": str(max(retry_after))}
+    return results, 200, {}
+
+
+def build_confirmation_email(transaction, connection=None):
+    """Build the payment confirmation email for a completed transaction."""
+    user_name = "Customer"
+    if transaction.user and transaction.user.first_name:
+        user_name = transaction.user.first_name
+    return EmailMessage(
+        subject=f"Your Payment for Order {transaction.order_id} is Confirmed!",
+        body=(
+            f"Hi {user_name},\n\n"
+            f"This is to confirm that we have received your payment of KES {transaction.amount}.\n"
+            f"Your order is now being processed.\n\n"
+            f"Thank you for your purchase!\n"
+        ),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[transaction.email],
+        connection=connection,
+    )
+
+
+def ipn_terminal_key(order_tracking_id):
+    """Cache key marking a transaction whose IPN has settled it in a terminal state."""
+    return f"pesapal:ipn:terminal:{order_tracking_id}"
+
+
+def ipn_lock_key(order_tracking_id):
+    """Cache key held while the order's queued IPN notifications are being processed."""
+    return f"pesapal:ipn:lock:{order_tracking_id}"
+
+
+def ipn_queued_key(order_tracking_id):
+    """Cache key set while a processing task for the order's notifications is queued."""
+    return f"pesapal:ipn:queued:{order_tracking_id}"
+
+
+def encode_history_cursor(created_at, pk):
+    """Opaque cursor of the history page after the row (created_at, pk)."""
+    data = json.dumps([created_at.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_history_cursor(cursor):
+    """Return the (created_at, pk) of a history cursor, or None if it is invalid."""
+    try:
+        created_at, pk = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created_at = parse_datetime(created_at)
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if created_at is None or not isinstance(pk, int):
+        return None
+    return created_at, pk
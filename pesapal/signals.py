@@ -1,32 +1,63 @@
 import logging
+from functools import partial
 
-from django.db.models.signals import pre_save
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
+from .events import publish_status_events
 from .models import PesapalTransaction
-from .tasks import send_payment_confirmation_email
+from .status_cache import invalidate_status_cache, status_payload
+from .tasks import enqueue_payment_confirmations
 
 logger = logging.getLogger(__name__)
 
 
 @receiver(pre_save, sender=PesapalTransaction)
-def on_transaction_status_change(sender, instance, **kwargs):
+def remember_loaded_status(sender, instance, **kwargs):
+    """
+    Make sure the stored status is known before an existing transaction is written.
+
+    Instances loaded from the database already carry it (PesapalTransaction.from_db),
+    so this only queries for instances built by hand or loaded with status deferred.
+    """
+    if instance.pk is None or hasattr(instance, "_loaded_status"):
+        return
+    instance._loaded_status = (
+        sender.objects.filter(pk=instance.pk).values_list("status", flat=True).first()
+    )
+
+
+@receiver(post_save, sender=PesapalTransaction)
+def on_transaction_status_change(sender, instance, created, **kwargs):
     """
     Listens for a change in the transaction status and triggers business logic
     when a payment is successfully completed.
     """
+    previous_status = getattr(instance, "_loaded_status", None)
+    instance._loaded_status = instance.status
+
     # We only care about updates to existing transactions, not new ones.
-    if instance.pk is None:
+    if created:
         return
 
-    try:
-        # Get the state of the object as it is in the database before this save.
-        old_instance = sender.objects.get(pk=instance.pk)
-    except sender.DoesNotExist:
-        return  # Should not happen for an existing instance, but good to be safe.
+    if previous_status != instance.status:
+        invalidate_status_cache([instance.order_tracking_id])
+        publish_status_events([status_payload(instance)])
 
     # Check if the status has changed from a non-completed state to COMPLETED.
-    if old_instance.status != "COMPLETED" and instance.status == "COMPLETED":
+    if previous_status != "COMPLETED" and instance.status == "COMPLETED":
         logger.info(f"Transaction {instance.order_id} completed. Triggering post-payment actions.")
-        # Use .delay() to run this as an asynchronous Celery task.
-        send_payment_confirmation_email.delay(instance.id)
+        enqueue_payment_confirmations([instance.id])
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_authenticated_user(sender, instance, **kwargs):
+    """Drop the cached user of CachedJWTAuthentication, e.g. after a deactivation."""
+    # Imported here: the DRF/simplejwt stack it pulls in isn't needed at boot.
+    from .authentication import invalidate_cached_user
+
+    # After commit, or a concurrent request could cache the old row again in between.
+    db_transaction.on_commit(partial(invalidate_cached_user, instance.pk))
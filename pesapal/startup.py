@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+# Boot cost of the web and Celery worker processes.
+#
+# Each entry point is started in a fresh interpreter, as a gunicorn or Celery worker would
+# be, optionally under `python -X importtime` to attribute the time to modules. Used by
+# the profile_startup command and benchmarks/startup.py.
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+ENTRY_POINTS = {
+    # What a gunicorn worker loads before answering its first request.
+    "web": (
+        "import safari.wsgi\n"
+        "from django.urls import get_resolver\n"
+        "get_resolver().url_patterns\n"
+    ),
+    # What `celery -A safari worker` loads before taking its first task.
+    "worker": (
+        "from safari.celery import app\n"
+        "app.loader.import_default_modules()\n"
+    ),
+}
+
+# Dependencies only needed once the first Pesapal call or Redis publish is made; loading
+# them at boot is a regression (see the lazy imports in utils.pesapal and pesapal.events).
+LAZY_MODULES = ("httpx", "redis")
+
+
+def run_entry_point(entry, importtime=False, code=""):
+    """Boot `entry` in a new interpreter; returns (seconds, stdout, stderr)."""
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "safari.settings")}
+    started = time.perf_counter()
+    result = subprocess.run(
+        args + ["-c", ENTRY_POINTS[entry] + code],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        raise RuntimeError(f"Starting the {entry} entry point failed:\n{result.stderr[-2000:]}")
+    return elapsed, result.stdout, result.stderr
+
+
+def parse_importtime(output):
+    """Parse `-X importtime` output into [(module, self_us, cumulative_us)]."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def by_package(modules):
+    """Total self time per top-level package, slowest first, as [(package, us)]."""
+    totals = defaultdict(int)
+    for name, self_us, _ in modules:
+        totals[name.split(".")[0]] += self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def loaded_lazy_modules(entry):
+    """The LAZY_MODULES that booting `entry` imports."""
+    _, stdout, _ = run_entry_point(
+        entry, code=f"import sys\nprint(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))\n"
+    )
+    return stdout.split()
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+
+from safari.db import use_replica
+from .models import PesapalTransaction
+from utils.circuit_breaker import CircuitOpenError
+from utils.rate_limiter import RateLimited
+from .services import map_payment_status
+
+# Read-through cache in front of PesapalCheckStatusView.
+#
+# - pesapal:status:<id>           the response payload; long-lived once terminal,
+#                                 a few seconds while PENDING.
+# - pesapal:status:checked:<id>   set for PESAPAL_STATUS_MIN_CHECK_INTERVAL after an
+#                                 upstream check, so each order is checked at most once
+#                                 per interval however many clients poll it.
+# - pesapal:status:inflight:<id>  set while that check runs; concurrent polls wait for
+#                                 its result instead of reading stale state.
+
+
+def status_cache_key(order_tracking_id):
+    return f"pesapal:status:{order_tracking_id}"
+
+
+def _checked_key(order_tracking_id):
+    return f"pesapal:status:checked:{order_tracking_id}"
+
+
+def _inflight_key(order_tracking_id):
+    return f"pesapal:status:inflight:{order_tracking_id}"
+
+
+def _inflight_timeout():
+    # An upstream check cannot outlive the client's timeouts (plus retries).
+    return int(settings.PESAPAL_CONNECT_TIMEOUT + settings.PESAPAL_READ_TIMEOUT) + 1
+
+
+def status_payload(transaction):
+    """The response body of the status endpoint for a transaction."""
+    return {
+        "order_id": transaction.order_id,
+        "order_tracking_id": transaction.order_tracking_id,
+        "status": transaction.status,
+        "updated_at": transaction.updated_at.isoformat(),
+    }
+
+
+def _payload_timeout(payload):
+    if payload["status"] in PesapalTransaction.TERMINAL_STATUSES:
+        return settings.PESAPAL_STATUS_CACHE_TERMINAL_TIMEOUT
+    return settings.PESAPAL_STATUS_CACHE_PENDING_TIMEOUT
+
+
+def invalidate_status_cache(order_tracking_ids):
+    """Drop cached payloads once the current database transaction commits."""
+    keys = [status_cache_key(tracking_id) for tracking_id in order_tracking_ids if tracking_id]
+    if keys:
+        db_transaction.on_commit(partial(cache.delete_many, keys))
+
+
+def _settle_pending(transaction, new_status):
+    """
+    Save `new_status` on a transaction read as PENDING; returns the primary's row.
+
+    `transaction` may come from a lagging replica, so it is re-read from the primary
+    first: a row already settled by an IPN or reconciliation is left alone, so its
+    status event is not sent twice and its updated_at is kept.
+    """
+    if settings.DATABASE_REPLICAS:
+        transaction.refresh_from_db()
+    if transaction.status == "PENDING":
+        transaction.status = new_status
+        transaction.save(update_fields=["status", "updated_at"])
+    return transaction
+
+
+def get_transaction_status(order_tracking_id, check_status):
+    """
+    Return the status payload for a transaction, reading through the cache.
+
+    PENDING transactions are re-checked upstream with `check_status` at most once
+    per minimum interval (and not while the Pesapal circuit breaker is open).
+    Raises PesapalTransaction.DoesNotExist for unknown IDs.
+    """
+    key = status_cache_key(order_tracking_id)
+    payload = cache.get(key)
+    if payload is not None:
+        return payload
+
+    try:
+        with use_replica():
+            transaction = PesapalTransaction.objects.get(order_tracking_id=order_tracking_id)
+    except PesapalTransaction.DoesNotExist:
+        if not settings.DATABASE_REPLICAS:
+            raise
+        # The row may not have reached the replica yet.
+        transaction = PesapalTransaction.objects.get(order_tracking_id=order_tracking_id)
+
+    if transaction.status == "PENDING":
+        if cache.add(_checked_key(order_tracking_id), True, timeout=settings.PESAPAL_STATUS_MIN_CHECK_INTERVAL):
+            cache.set(_inflight_key(order_tracking_id), True, timeout=_inflight_timeout())
+            try:
+                new_status = map_payment_status(check_status(order_tracking_id))
+                if new_status and new_status != transaction.status:
+                    transaction = _settle_pending(transaction, new_status)
+            except (CircuitOpenError, RateLimited):
+                # Pesapal is down or busy; answer with the status we have.
+                pass
+            finally:
+                cache.delete(_inflight_key(order_tracking_id))
+        elif cache.get(_inflight_key(order_tracking_id)):
+            deadline = time.monotonic() + settings.PESAPAL_STATUS_COALESCE_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                payload = cache.get(key)
+                if payload is not None:
+                    return payload
+            transaction.refresh_from_db()
+
+    payload = status_payload(transaction)
+    cache.set(key, payload, timeout=_payload_timeout(payload))
+    return payload
+
+
+async def aget_transaction_status(order_tracking_id, check_status):
+    """Async version of get_transaction_status(); `check_status` is a coroutine function."""
+    key = status_cache_key(order_tracking_id)
+    payload = await cache.aget(key)
+    if payload is not None:
+        return payload
+
+    try:
+        with use_replica():
+            transaction = await PesapalTransaction.objects.aget(order_tracking_id=order_tracking_id)
+    except PesapalTransaction.DoesNotExist:
+        if not settings.DATABASE_REPLICAS:
+            raise
+        transaction = await PesapalTransaction.objects.aget(order_tracking_id=order_tracking_id)
+
+    if transaction.status == "PENDING":
+        if await cache.aadd(_checked_key(order_tracking_id), True,
+                            timeout=settings.PESAPAL_STATUS_MIN_CHECK_INTERVAL):
+            await cache.aset(_inflight_key(order_tracking_id), True, timeout=_inflight_timeout())
+            try:
+                new_status = map_payment_status(await check_status(order_tracking_id))
+                if new_status and new_status != transaction.status:
+                    transaction = await sync_to_async(_settle_pending)(transaction, new_status)
+            except (CircuitOpenError, RateLimited):
+                pass
+            finally:
+                await cache.adelete(_inflight_key(order_tracking_id))
+        elif await cache.aget(_inflight_key(order_tracking_id)):
+            deadline = time.monotonic() + settings.PESAPAL_STATUS_COALESCE_WAIT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                payload = await cache.aget(key)
+                if payload is not None:
+                    return payload
+            await transaction.arefresh_from_db()
+
+    payload = status_payload(transaction)
+    await cache.aset(key, payload, timeout=_payload_timeout(payload))
+    return payload
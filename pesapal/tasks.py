@@ -1,83 +1,485 @@
 from celery import shared_task
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.db.models import F, Q
 from django.utils import timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from datetime import timedelta
+from functools import partial
 import logging
+import random
+import time
 
-from .models import PesapalTransaction
-from utils.pesapal import check_transaction_status
+from .archive import ARCHIVE_LOCK_KEY, archive_transactions
+from .models import PaymentConfirmation, PesapalNotification, PesapalTransaction
+from utils.pesapal import BACKGROUND, CircuitOpenError, RateLimited, check_transaction_status, get_client
+from .events import publish_status_events
+from .locks import acquire_lock, release_lock
+from .metrics import record_confirmation_emails, record_ipn_processed, record_ipn_received
+from .services import (
+    build_confirmation_email,
+    ipn_lock_key,
+    ipn_queued_key,
+    ipn_terminal_key,
+    map_payment_status,
+)
+from .status_cache import invalidate_status_cache
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
 
+VERIFY_LOCK_KEY = "pesapal:verify_pending_transactions:lock"
+CONFIRMATIONS_LOCK_KEY = "pesapal:send_payment_confirmations:lock"
+# Approximate number of confirmations queued since the last send; triggers a batch early.
+CONFIRMATIONS_QUEUED_KEY = "pesapal:send_payment_confirmations:queued"
+
+
+def enqueue_payment_confirmations(transaction_ids):
+    """
+    Queue the post-payment actions for completed transactions.
+
+    Confirmations are written to the outbox in the surrounding database transaction, so
+    an email is queued exactly when the status change commits, and sent in batches by
+    send_payment_confirmations.
+    """
+    PaymentConfirmation.objects.bulk_create(
+        [PaymentConfirmation(transaction_id=pk) for pk in transaction_ids], ignore_conflicts=True
+    )
+    db_transaction.on_commit(partial(_confirmations_queued, len(transaction_ids)))
+
+
+def _confirmations_queued(count):
+    # A full batch is sent straight away; smaller ones wait for the beat schedule.
+    cache.add(CONFIRMATIONS_QUEUED_KEY, 0, timeout=None)
+    try:
+        queued = cache.incr(CONFIRMATIONS_QUEUED_KEY, count)
+    except ValueError:
+        cache.add(CONFIRMATIONS_QUEUED_KEY, count, timeout=None)
+        queued = count
+    if queued >= settings.PESAPAL_EMAIL_BATCH_SIZE:
+        cache.delete(CONFIRMATIONS_QUEUED_KEY)
+        send_payment_confirmations.delay()
+
+
+def queue_ipn_notification(order_tracking_id, merchant_reference, notification_type=""):
+    """Store an IPN delivery and schedule its processing once the current transaction commits."""
+    notification = PesapalNotification.objects.create(
+        order_tracking_id=order_tracking_id,
+        merchant_reference=merchant_reference,
+        notification_type=notification_type,
+    )
+    record_ipn_received("queued")
+    db_transaction.on_commit(partial(_send_ipn_processing, order_tracking_id))
+    return notification
+
+
+def _send_ipn_processing(order_tracking_id):
+    # One queued task per order: repeat deliveries arriving before it starts ride along.
+    queued_key = ipn_queued_key(order_tracking_id)
+    if not cache.add(queued_key, True, timeout=settings.PESAPAL_IPN_REQUEUE_AFTER):
+        return
+    try:
+        process_ipn_notifications.delay(order_tracking_id)
+    except Exception as e:
+        # The notification is stored; requeue_stale_ipn_notifications picks it up.
+        cache.delete(queued_key)
+        logger.error(f"Failed to queue IPN processing for {order_tracking_id}: {e}")
+
+
+def _fetch_new_status(order_tracking_id):
+    """Ask Pesapal for a transaction's status; returns (new_status, error)."""
+    try:
+        # Reconciliation gives way to user-facing calls under the rate limit.
+        return map_payment_status(check_transaction_status(order_tracking_id, priority=BACKGROUND)), None
+    except Exception as e:
+        logger.error(f"Error verifying transaction {order_tracking_id}: {str(e)}")
+        return None, e
+
+
+def _apply_status_updates(updates):
+    """
+    Move PENDING transactions to their new status with one UPDATE per status.
+
+    The update is conditional on the row still being PENDING, so a concurrent
+    callback that already settled a transaction is not overwritten. Bulk updates
+    bypass model signals, so post-payment actions are dispatched here.
+    """
+    updated = 0
+    now = timezone.now()
+    for new_status, pks in updates.items():
+        with db_transaction.atomic():
+            rows = list(
+                PesapalTransaction.objects.select_for_update()
+                .filter(pk__in=pks, status="PENDING")
+                .values_list("pk", "order_id", "order_tracking_id")
+            )
+            if not rows:
+                continue
+            changed = [pk for pk, _, _ in rows]
+            PesapalTransaction.objects.filter(pk__in=changed).update(status=new_status, updated_at=now)
+            invalidate_status_cache([tracking_id for _, _, tracking_id in rows])
+            publish_status_events([
+                {
+                    "order_id": order_id,
+                    "order_tracking_id": tracking_id,
+                    "status": new_status,
+                    "updated_at": now.isoformat(),
+                }
+                for _, order_id, tracking_id in rows
+            ])
+            if new_status == "COMPLETED":
+                enqueue_payment_confirmations(changed)
+        updated += len(changed)
+    return updated
+
+
+def next_check_at(check_attempts, now=None):
+    """When a PENDING order that has had `check_attempts` checks is checked next."""
+    delay = min(
+        settings.PESAPAL_RECONCILE_MAX_INTERVAL,
+        settings.PESAPAL_RECONCILE_FIRST_CHECK * 2 ** check_attempts,
+    )
+    jitter = settings.PESAPAL_RECONCILE_JITTER
+    return (now or timezone.now()) + timedelta(seconds=delay * random.uniform(1 - jitter, 1 + jitter))
+
+
 @shared_task
 def verify_pending_transactions():
     """
-    Periodically checks for transactions that are still in a PENDING state
-    after a certain amount of time and verifies their status with Pesapal.
+    Check the PENDING transactions that are due with Pesapal.
     This acts as a fallback for failed IPN callbacks.
+
+    Every transaction carries its own schedule (next_check_at): the first check comes a
+    few minutes after creation, giving the IPN a chance to arrive, and each check that
+    leaves it pending doubles the interval to the next one. Orders still pending after
+    PESAPAL_RECONCILE_MAX_AGE are marked EXPIRED. Runs are frequent and only read the
+    rows that are due, so the load follows the order flow instead of spiking.
+
+    Due rows are read in keyset-paginated chunks, each chunk is checked with bounded
+    concurrency and status changes and new schedules are written in bulk. A cache lock
+    keeps runs from overlapping, and a run stops once its time budget is spent, dropping
+    the checks of its current chunk that have not completed; the remaining rows are
+    picked up by the next run.
     """
-    # Check for transactions that are pending, have a tracking ID, and are older than 15 minutes.
-    # This delay gives the regular IPN callback a chance to arrive first.
-    time_threshold = timezone.now() - timedelta(minutes=15)
-    pending_transactions = PesapalTransaction.objects.filter(
-        status='PENDING',
-        created_at__lt=time_threshold,
-        order_tracking_id__isnull=False
+    token = acquire_lock(VERIFY_LOCK_KEY, settings.PESAPAL_RECONCILE_TIME_BUDGET + 60)
+    if token is None:
+        logger.info("Previous verification run is still in progress. Skipping.")
+        return {"skipped": True}
+    try:
+        return _verify_pending_transactions()
+    finally:
+        release_lock(VERIFY_LOCK_KEY, token)
+
+
+def _verify_pending_transactions():
+    now = timezone.now()
+    expire_before = now - timedelta(seconds=settings.PESAPAL_RECONCILE_MAX_AGE)
+    # Walk due rows in (next_check_at, pk) order, which pesapal_pending_due_idx serves directly.
+    due_transactions = PesapalTransaction.objects.filter(
+        status="PENDING",
+        next_check_at__lte=now,
+        order_tracking_id__isnull=False,
+    ).order_by("next_check_at", "pk")
+
+    stats = {"checked": 0, "updated": 0, "expired": 0, "errors": 0, "chunks": 0, "complete": True}
+    started = time.monotonic()
+    deadline = started + settings.PESAPAL_RECONCILE_TIME_BUDGET
+    last_seen = None
+
+    with ThreadPoolExecutor(max_workers=settings.PESAPAL_RECONCILE_CONCURRENCY) as executor:
+        while True:
+            if time.monotonic() >= deadline:
+                stats["complete"] = False
+                logger.warning("Verification time budget exhausted; remaining transactions deferred to the next run.")
+                break
+            if get_client().breaker.is_open():
+                stats["complete"] = False
+                logger.warning("Pesapal circuit breaker is open; remaining transactions deferred to the next run.")
+                break
+
+            page = due_transactions
+            if last_seen is not None:
+                last_check_at, last_pk = last_seen
+                page = page.filter(next_check_at__gte=last_check_at).exclude(
+                    next_check_at=last_check_at, pk__lte=last_pk
+                )
+            chunk = list(
+                page.values_list(
+                    "pk", "order_tracking_id", "created_at", "check_attempts", "next_check_at"
+                )[:settings.PESAPAL_RECONCILE_CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+            last_seen = (chunk[-1][4], chunk[-1][0])
+
+            updates = defaultdict(list)
+            expired = []
+            rescheduled = []
+            rate_limited = False
+            out_of_time = False
+            checked = 0
+            futures = [executor.submit(_fetch_new_status, row[1]) for row in chunk]
+            for (pk, tracking_id, created_at, attempts, _), future in zip(chunk, futures):
+                try:
+                    new_status, error = future.result(timeout=max(0, deadline - time.monotonic()))
+                except FuturesTimeout:
+                    # Checks not started yet are dropped; unchecked rows stay due.
+                    for pending in futures:
+                        pending.cancel()
+                    out_of_time = True
+                    break
+                checked += 1
+                if isinstance(error, RateLimited):
+                    # Not a failed check; the order stays due.
+                    stats["errors"] += 1
+                    rate_limited = True
+                    continue
+                if error is not None:
+                    stats["errors"] += 1
+                elif new_status:
+                    logger.info(f"Updating transaction {tracking_id} from PENDING to {new_status}")
+                    updates[new_status].append(pk)
+                    continue
+                elif created_at <= expire_before:
+                    logger.info(f"Transaction {tracking_id} is still pending after the maximum age; expiring it")
+                    expired.append(pk)
+                    continue
+                rescheduled.append(
+                    PesapalTransaction(pk=pk, check_attempts=attempts + 1, next_check_at=next_check_at(attempts + 1))
+                )
+
+            stats["checked"] += checked
+            stats["updated"] += _apply_status_updates(updates)
+            if expired:
+                stats["expired"] += _apply_status_updates({PesapalTransaction.EXPIRED_STATUS: expired})
+            PesapalTransaction.objects.bulk_update(rescheduled, ["check_attempts", "next_check_at"])
+            stats["chunks"] += 1
+            if rate_limited:
+                stats["complete"] = False
+                logger.warning("Pesapal rate limit exhausted for background calls; remaining transactions deferred to the next run.")
+                break
+            if out_of_time:
+                stats["complete"] = False
+                logger.warning("Verification time budget exhausted mid-chunk; remaining transactions deferred to the next run.")
+                break
+
+    stats["duration"] = round(time.monotonic() - started, 3)
+    stats["throughput"] = round(stats["checked"] / stats["duration"], 2) if stats["duration"] else 0.0
+    logger.info(
+        f"Verification task completed. Checked {stats['checked']} transactions "
+        f"({stats['throughput']}/s), updated {stats['updated']}, expired {stats['expired']}, "
+        f"errors {stats['errors']}."
     )
+    return stats
+
+
+# Retries are counted against PESAPAL_IPN_MAX_RETRIES, so Celery's own limit is off.
+@shared_task(bind=True, max_retries=None)
+def process_ipn_notifications(self, order_tracking_id):
+    """
+    Process the queued IPN notifications of one order.
 
-    logger.info(f"Found {pending_transactions.count()} pending transactions to verify.")
+    An order's notifications are handled one batch at a time under its IPN lock, oldest
+    first, and every notification in a batch shares a single status check with Pesapal.
+    Failed batches are retried with backoff, then given up, leaving the transaction to
+    verify_pending_transactions.
+    """
+    # Cleared first, so a notification stored from now on queues a new task.
+    queued_key = ipn_queued_key(order_tracking_id)
+    cache.delete(queued_key)
+    lock_key = ipn_lock_key(order_tracking_id)
+    if not cache.add(lock_key, True, timeout=settings.PESAPAL_IPN_LOCK_TIMEOUT):
+        # Another worker is processing this order; keep its notifications in order.
+        # Marked queued again so neither new deliveries nor the requeue beat add a task.
+        cache.set(queued_key, True, timeout=settings.PESAPAL_IPN_REQUEUE_AFTER)
+        process_ipn_notifications.apply_async((order_tracking_id,), countdown=1)
+        return {"deferred": True}
+    try:
+        return _process_ipn_notifications(order_tracking_id)
+    except Exception as e:
+        if self.request.retries >= settings.PESAPAL_IPN_MAX_RETRIES:
+            _finish_ipn_notifications(
+                PesapalNotification.objects.filter(order_tracking_id=order_tracking_id, processed_at__isnull=True),
+                "FAILED",
+            )
+            logger.error(f"Giving up on IPN notifications for {order_tracking_id}: {e}")
+            return {"outcome": "FAILED"}
+        countdown = e.retry_after if isinstance(e, (CircuitOpenError, RateLimited)) else min(300, 5 * 2 ** self.request.retries)
+        # The retry is this order's queued task: keep the marker until it runs, or the
+        # requeue beat would start a second retry chain for the same notifications.
+        cache.set(queued_key, True, timeout=countdown + settings.PESAPAL_IPN_REQUEUE_AFTER)
+        raise self.retry(exc=e, countdown=countdown)
+    finally:
+        cache.delete(lock_key)
 
-    for transaction in pending_transactions:
-        try:
-            logger.info(f"Verifying transaction {transaction.order_tracking_id}...")
-            status_data = check_transaction_status(transaction.order_tracking_id)
-            payment_status = status_data.get("payment_status_description")
 
-            status_mapping = {"Completed": "COMPLETED", "Failed": "FAILED", "Cancelled": "CANCELLED"}
-            new_status = status_mapping.get(payment_status)
+def _process_ipn_notifications(order_tracking_id):
+    batch = list(
+        PesapalNotification.objects.filter(order_tracking_id=order_tracking_id, processed_at__isnull=True)
+        .order_by("received_at", "pk")
+        .values_list("pk", "merchant_reference", "received_at")
+    )
+    if not batch:
+        return {"processed": 0}
+    notifications = PesapalNotification.objects.filter(pk__in=[pk for pk, _, _ in batch])
 
-            if new_status:
-                logger.info(f"Updating transaction {transaction.order_tracking_id} from PENDING to {new_status}")
+    try:
+        # The row checked and updated is the one Pesapal knows by this tracking ID; the
+        # merchant reference (unauthenticated input) must match it.
+        transaction = PesapalTransaction.objects.filter(order_tracking_id=order_tracking_id).first()
+        if transaction is not None and transaction.order_id not in {reference for _, reference, _ in batch}:
+            transaction = None
+        if transaction is None:
+            outcome = "UNKNOWN_ORDER"
+        elif transaction.status in PesapalTransaction.TERMINAL_STATUSES:
+            outcome = "ALREADY_SETTLED"
+        else:
+            # To be certain, query Pesapal for the final transaction status
+            new_status = map_payment_status(check_transaction_status(order_tracking_id))
+            if new_status and new_status != transaction.status:
                 transaction.status = new_status
-                transaction.save()
-        except Exception as e:
-            logger.error(f"Error verifying transaction {transaction.order_tracking_id}: {str(e)}")
+                transaction.save(update_fields=["status", "updated_at"])
+                outcome = "UPDATED"
+            else:
+                outcome = "UNCHANGED"
+    except Exception as e:
+        notifications.update(attempts=F("attempts") + 1, last_error=str(e)[:1000])
+        raise
+
+    if transaction is not None and transaction.status in PesapalTransaction.TERMINAL_STATUSES:
+        cache.set(ipn_terminal_key(order_tracking_id), transaction.status,
+                  timeout=settings.PESAPAL_IPN_TERMINAL_CACHE_TIMEOUT)
+    _finish_ipn_notifications(notifications, outcome, [received_at for _, _, received_at in batch])
+    return {"processed": len(batch), "outcome": outcome}
+
 
-    return f"Verification task completed. Checked {pending_transactions.count()} transactions."
+def _finish_ipn_notifications(notifications, outcome, received=None):
+    now = timezone.now()
+    if received is None:
+        received = list(notifications.values_list("received_at", flat=True))
+    notifications.update(processed_at=now, outcome=outcome)
+    record_ipn_processed(outcome, [(now - received_at).total_seconds() for received_at in received])
+
+
+@shared_task
+def requeue_stale_ipn_notifications():
+    """Queue processing again for stored notifications whose task never ran (e.g. a lost message)."""
+    cutoff = timezone.now() - timedelta(seconds=settings.PESAPAL_IPN_REQUEUE_AFTER)
+    order_tracking_ids = list(
+        PesapalNotification.objects.filter(processed_at__isnull=True, received_at__lt=cutoff)
+        .values_list("order_tracking_id", flat=True)
+        .distinct()[:1000]
+    )
+    for order_tracking_id in order_tracking_ids:
+        _send_ipn_processing(order_tracking_id)
+    if order_tracking_ids:
+        logger.warning(f"Re-queued IPN processing for {len(order_tracking_ids)} orders.")
+    return len(order_tracking_ids)
 
 
 @shared_task
+def send_payment_confirmations():
+    """
+    Send the due confirmation emails in the outbox over a single mail connection.
+
+    The outbox is read in batches of PESAPAL_EMAIL_BATCH_SIZE, each loading its
+    transactions and users in one query and marked in bulk. A failed message is retried
+    by a later run with exponential backoff, up to PESAPAL_EMAIL_MAX_ATTEMPTS attempts.
+    A run stops after a batch in which nothing could be sent, as the mail server is
+    most likely down.
+    """
+    token = acquire_lock(CONFIRMATIONS_LOCK_KEY, settings.PESAPAL_EMAIL_LOCK_TIMEOUT)
+    if token is None:
+        logger.info("Confirmation emails are already being sent. Skipping.")
+        return {"skipped": True}
+    try:
+        return _send_payment_confirmations()
+    finally:
+        release_lock(CONFIRMATIONS_LOCK_KEY, token)
+
+
+def _send_payment_confirmations():
+    cache.delete(CONFIRMATIONS_QUEUED_KEY)
+    started = timezone.now()
+    # Walked in (next_attempt_at, pk) order from the last row of the previous batch.
+    due = (
+        PaymentConfirmation.objects.filter(
+            sent_at__isnull=True,
+            attempts__lt=settings.PESAPAL_EMAIL_MAX_ATTEMPTS,
+            next_attempt_at__lte=started,
+        )
+        .select_related("transaction__user")
+        .order_by("next_attempt_at", "pk")
+    )
+    stats = {"sent": 0, "failed": 0, "batches": 0}
+
+    with mail.get_connection() as connection:
+        last_seen = None
+        while True:
+            page = due
+            if last_seen is not None:
+                last_attempt_at, last_pk = last_seen
+                page = page.filter(
+                    Q(next_attempt_at__gt=last_attempt_at) | Q(next_attempt_at=last_attempt_at, pk__gt=last_pk)
+                )
+            batch = list(page[:settings.PESAPAL_EMAIL_BATCH_SIZE])
+            if not batch:
+                break
+            last_seen = (batch[-1].next_attempt_at, batch[-1].pk)
+            sent, failed = [], []
+            for confirmation in batch:
+                try:
+                    build_confirmation_email(confirmation.transaction, connection=connection).send()
+                    sent.append(confirmation.pk)
+                except Exception as e:
+                    logger.error(f"Failed to send confirmation email for transaction ID {confirmation.transaction_id}: {e}")
+                    confirmation.attempts += 1
+                    confirmation.last_error = str(e)[:1000]
+                    confirmation.next_attempt_at = timezone.now() + timedelta(
+                        seconds=settings.PESAPAL_EMAIL_RETRY_BACKOFF * 2 ** (confirmation.attempts - 1)
+                    )
+                    failed.append(confirmation)
+            if sent:
+                PaymentConfirmation.objects.filter(pk__in=sent).update(sent_at=timezone.now())
+            if failed:
+                PaymentConfirmation.objects.bulk_update(failed, ["attempts", "last_error", "next_attempt_at"])
+            record_confirmation_emails(len(sent), len(failed))
+            stats["sent"] += len(sent)
+            stats["failed"] += len(failed)
+            stats["batches"] += 1
+            if not sent:
+                logger.warning("No confirmation email in the batch could be sent; deferring the rest to the next run.")
+                break
+
+    if stats["batches"]:
+        logger.info(f"Sent {stats['sent']} confirmation emails in {stats['batches']} batches, {stats['failed']} failed.")
+    return stats
+
+
+@shared_task(query_budget=1)
 def send_payment_confirmation_email(transaction_id):
     """
-    Sends a payment confirmation email to the user.
-    This is triggered after a transaction status is updated to COMPLETED.
+    Add a transaction to the confirmation outbox.
+    Kept for task messages published before the outbox existed.
     """
+    enqueue_payment_confirmations([transaction_id])
+
+
+@shared_task
+def archive_old_transactions():
+    """
+    Move terminal transactions older than PESAPAL_ARCHIVE_AFTER_DAYS out of the hot table,
+    into the archive table or, if PESAPAL_ARCHIVE_EXPORT_DIR is set, compressed files.
+    """
+    token = acquire_lock(ARCHIVE_LOCK_KEY, settings.PESAPAL_ARCHIVE_TIME_BUDGET + 60)
+    if token is None:
+        logger.info("Previous archival run is still in progress. Skipping.")
+        return {"skipped": True}
     try:
-        transaction = PesapalTransaction.objects.get(id=transaction_id)
-        user_name = "Customer"
-        if transaction.user and transaction.user.first_name:
-            user_name = transaction.user.first_name
-
-        logger.info(f"Sending confirmation email for transaction {transaction.order_id} to {transaction.email}")
-
-        # --- Add your email sending logic here ---
-        # from django.core.mail import send_mail
-        #
-        # subject = f"Your Payment for Order {transaction.order_id} is Confirmed!"
-        # message = (
-        #     f"Hi {user_name},\n\n"
-        #     f"This is to confirm that we have received your payment of KES {transaction.amount}.\n"
-        #     f"Your order is now being processed.\n\n"
-        #     f"Thank you for your purchase!\n"
-        # )
-        # send_mail(subject, message, 'noreply@yourdomain.com', [transaction.email])
-        # -----------------------------------------
-
-        return f"Email queued for transaction ID {transaction_id}"
-    except PesapalTransaction.DoesNotExist:
-        logger.error(f"Cannot send email. Transaction with ID {transaction_id} not found.")
-    except Exception as e:
-        logger.error(f"Failed to send confirmation email for transaction ID {transaction_id}: {e}")
-        # Celery can be configured to retry the task on failure.
-        raise
+        return archive_transactions(export_dir=settings.PESAPAL_ARCHIVE_EXPORT_DIR or None)
+    finally:
+        release_lock(ARCHIVE_LOCK_KEY, token)
@@ -1,9 +1,42 @@
 # urls.py
+from django.conf import settings
 from django.urls import path
-from .views import PesapalInitPaymentView, PesapalCallbackView, PesapalCheckStatusView
+
+from .async_views import PesapalStatusStreamView
+from .views import ArchivedTransactionView, TransactionExportView, TransactionHistoryView
+
+if settings.PESAPAL_ASYNC_VIEWS:
+    # Async views for ASGI deployments; same routes and names as the sync ones.
+    from .async_views import (
+        AsyncPesapalInitPaymentView as PesapalInitPaymentView,
+        AsyncPesapalBatchInitPaymentView as PesapalBatchInitPaymentView,
+        AsyncPesapalCallbackView as PesapalCallbackView,
+        AsyncPesapalCheckStatusView as PesapalCheckStatusView,
+    )
+else:
+    from .views import (
+        PesapalInitPaymentView,
+        PesapalBatchInitPaymentView,
+        PesapalCallbackView,
+        PesapalCheckStatusView,
+    )
 
 urlpatterns = [
     path("pesapal/initiate/", PesapalInitPaymentView.as_view(), name="pesapal-initiate"),
+    path("pesapal/initiate/batch/", PesapalBatchInitPaymentView.as_view(), name="pesapal-initiate-batch"),
     path("pesapal/callback/", PesapalCallbackView.as_view(), name="pesapal-callback"),
     path("pesapal/status/<str:order_tracking_id>/", PesapalCheckStatusView.as_view(), name="pesapal-status"),
+    path(
+        "pesapal/archive/<str:order_tracking_id>/",
+        ArchivedTransactionView.as_view(),
+        name="pesapal-archived-transaction",
+    ),
+    path("pesapal/transactions/", TransactionHistoryView.as_view(), name="pesapal-transaction-history"),
+    path("pesapal/export/", TransactionExportView.as_view(), name="pesapal-transaction-export"),
+    # Server-Sent Events; always async, serve it from the ASGI app (safari/asgi.py).
+    path(
+        "pesapal/status/<str:order_tracking_id>/stream/",
+        PesapalStatusStreamView.as_view(),
+        name="pesapal-status-stream",
+    ),
 ]
@@ -1,12 +1,44 @@
+import hashlib
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.authentication import SessionAuthentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 
-from utils.pesapal import submit_order, check_transaction_status
-from .models import PesapalTransaction
+from utils.pesapal import CircuitOpenError, RateLimited, submit_order, check_transaction_status
+from .authentication import ClaimsJWTAuthentication
+from .idempotency import (
+    IDEMPOTENCY_HEADER,
+    MAX_KEY_LENGTH,
+    REPLAYED_HEADERS,
+    request_fingerprint,
+    run_idempotent,
+)
+from .export import EXPORT_FORMATS, export_filename, parse_export_bound, stream_export
+from .metrics import record_ipn_received
+from safari.db import use_replica
+from .models import ArchivedTransaction, PesapalTransaction
+from .services import (
+    PAYMENTS_UNAVAILABLE_MESSAGE,
+    apply_batch_outcomes,
+    build_order_payload,
+    decode_history_cursor,
+    encode_history_cursor,
+    ipn_terminal_key,
+    new_batch_transactions,
+    parse_batch_payments,
+)
+from .status_cache import get_transaction_status, status_payload
+from .tasks import queue_ipn_notification
 
 # It's good practice to use serializers for data validation and deserialization.
 # For simplicity, we are doing it manually here.
@@ -16,11 +48,37 @@ class PesapalInitPaymentView(APIView):
     """
     Receive total amount + user details from frontend,
     and initiate payment with Pesapal.
+
+    Clients retrying on a flaky network send an Idempotency-Key header; repeats of a
+    request with the same key get its original response (see pesapal.idempotency).
     """
 
     permission_classes = [IsAuthenticated]
+    # User lookup (JWT), INSERT, tracking ID UPDATE.
+    query_budget = 3
 
     def post(self, request):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return self.initiate(request)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {"error": f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        fingerprint = request_fingerprint(
+            {"amount": request.data.get("amount"), "phone_number": request.data.get("phone_number", "")}
+        )
+
+        def handler():
+            response = self.initiate(request)
+            headers = {name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)}
+            return response.status_code, response.data, headers
+
+        status_code, body, headers = run_idempotent(request.user.pk, key, fingerprint, handler)
+        return Response(body, status=status_code, headers=headers)
+
+    def initiate(self, request):
         user = request.user
         amount = request.data.get("amount")
         # Phone number can be optional in the request body
@@ -50,21 +108,7 @@ class PesapalInitPaymentView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        payload = {
-            "id": order_id,
-            "currency": "KES",
-            "amount": float(amount),
-            "description": "Payment for goods",
-            "callback_url": settings.PESAPAL_CALLBACK_URL,
-            "notification_id": settings.PESAPAL_NOTIFICATION_ID,
-            "billing_address": {
-                "email_address": user.email,
-                "phone_number": phone_number,
-                "country_code": "KE",
-                "first_name": user.first_name or "Guest",
-                "last_name": user.last_name or "User",
-            },
-        }
+        payload = build_order_payload(order_id, amount, user, phone_number)
 
         try:
             response_data = submit_order(payload)
@@ -72,24 +116,81 @@ class PesapalInitPaymentView(APIView):
             # Update transaction with Pesapal's tracking ID
             if response_data.get("order_tracking_id"):
                 transaction.order_tracking_id = response_data.get("order_tracking_id")
-                transaction.save()
+                transaction.save(update_fields=["order_tracking_id", "updated_at"])
 
             return Response(response_data, status=status.HTTP_200_OK)
+        except (CircuitOpenError, RateLimited) as e:
+            # Pesapal is down or we are over our rate limit: fail fast instead of holding the
+            # worker; the order was never submitted.
+            transaction.status = "FAILED"
+            transaction.save(update_fields=["status", "updated_at"])
+            return Response(
+                {"error": PAYMENTS_UNAVAILABLE_MESSAGE},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(e.retry_after)},
+            )
         except Exception as e:
             # If submission fails, mark our transaction as FAILED
             transaction.status = "FAILED"
-            transaction.save()
+            transaction.save(update_fields=["status", "updated_at"])
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
 
+def _submit_batch_order(payload):
+    """submit_order() for a batch item; returns (response_data, error)."""
+    try:
+        return submit_order(payload), None
+    except Exception as e:
+        return None, e
+
+
+class PesapalBatchInitPaymentView(APIView):
+    """
+    Initiate several Pesapal payments at once, e.g. one per seller of a marketplace checkout.
+
+    The transactions are inserted in one query and submitted to Pesapal concurrently
+    (PESAPAL_BATCH_CONCURRENCY at a time), so the request takes about one Pesapal round
+    trip; tracking IDs and failures are then saved in one bulk update. Returns a result
+    per payment, in request order.
+    """
+
+    permission_classes = [IsAuthenticated]
+    # User lookup (JWT), bulk INSERT, bulk UPDATE.
+    query_budget = 3
+
+    def post(self, request):
+        payments, error = parse_batch_payments(request.data)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = request.user
+        transactions = PesapalTransaction.objects.bulk_create(new_batch_transactions(user, payments))
+        payloads = [
+            build_order_payload(transaction.order_id, transaction.amount, user, transaction.phone_number)
+            for transaction in transactions
+        ]
+        with ThreadPoolExecutor(max_workers=min(settings.PESAPAL_BATCH_CONCURRENCY, len(payloads))) as executor:
+            outcomes = list(executor.map(_submit_batch_order, payloads))
+
+        results, status_code, headers = apply_batch_outcomes(transactions, outcomes)
+        PesapalTransaction.objects.bulk_update(transactions, ["order_tracking_id", "status", "updated_at"])
+        return Response({"results": results}, status=status_code, headers=headers)
+
+
 class PesapalCallbackView(APIView):
     """
     Handle IPN (Instant Payment Notification) callback from Pesapal.
     This view is called by Pesapal to notify of a transaction status change.
+
+    The notification is stored and acknowledged straight away; process_ipn_notifications
+    confirms the status with Pesapal in the background.
     """
 
+    # Transaction lookup, notification INSERT.
+    query_budget = 2
+
     def post(self, request):
         data = request.data
         order_tracking_id = data.get("OrderTrackingId")
@@ -101,29 +202,32 @@ class PesapalCallbackView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        try:
-            transaction = PesapalTransaction.objects.get(order_id=merchant_reference)
-
-            # To be certain, query Pesapal for the final transaction status
-            status_data = check_transaction_status(order_tracking_id)
-            payment_status = status_data.get("payment_status_description")
-
-            if payment_status:
-                status_mapping = {
-                    "Completed": "COMPLETED",
-                    "Failed": "FAILED",
-                    "Cancelled": "CANCELLED",
-                }
-                new_status = status_mapping.get(payment_status)
-                if new_status:
-                    transaction.status = new_status
-                    transaction.save()
-
+        # Pesapal retries IPNs; answer repeats for settled orders without touching the database.
+        if cache.get(ipn_terminal_key(order_tracking_id)):
+            record_ipn_received("settled")
             return Response({"message": "Callback processed"}, status=status.HTTP_200_OK)
-        except PesapalTransaction.DoesNotExist:
-            return Response(
-                {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+
+        try:
+            # Both IDs must match the row: the terminal marker below is keyed on the tracking
+            # ID, and this endpoint is unauthenticated.
+            transaction_status = (
+                PesapalTransaction.objects.filter(order_id=merchant_reference, order_tracking_id=order_tracking_id)
+                .values_list("status", flat=True)
+                .first()
             )
+            if transaction_status is None:
+                record_ipn_received("unknown_order")
+                return Response(
+                    {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+                )
+            if transaction_status in PesapalTransaction.TERMINAL_STATUSES:
+                cache.set(ipn_terminal_key(order_tracking_id), transaction_status,
+                          timeout=settings.PESAPAL_IPN_TERMINAL_CACHE_TIMEOUT)
+                record_ipn_received("settled")
+                return Response({"message": "Callback processed"}, status=status.HTTP_200_OK)
+
+            queue_ipn_notification(order_tracking_id, merchant_reference, data.get("OrderNotificationType") or "")
+            return Response({"message": "Callback received"}, status=status.HTTP_200_OK)
         except Exception as e:
             # Log this error
             return Response(
@@ -137,36 +241,18 @@ class PesapalCheckStatusView(APIView):
     Allows the frontend to check the transaction status from our system.
     """
 
+    # Open to anyone holding the tracking ID; a token is only read, never looked up.
+    authentication_classes = [ClaimsJWTAuthentication, SessionAuthentication]
+    # Transaction lookup on a cache miss, its re-read on the primary (with replicas) and
+    # status UPDATE when Pesapal reports a change, confirmation outbox INSERT when that
+    # change completes the payment.
+    query_budget = 4
+
     def get(self, request, order_tracking_id):
         try:
-            # First, check our local database
-            transaction = PesapalTransaction.objects.get(
-                order_tracking_id=order_tracking_id
-            )
-
-            # If status is still pending, re-check with Pesapal to get the latest update
-            if transaction.status == "PENDING":
-                status_data = check_transaction_status(order_tracking_id)
-                payment_status = status_data.get("payment_status_description")
-
-                if payment_status:
-                    status_mapping = {
-                        "Completed": "COMPLETED",
-                        "Failed": "FAILED",
-                        "Cancelled": "CANCELLED",
-                    }
-                    new_status = status_mapping.get(payment_status)
-                    if new_status and new_status != transaction.status:
-                        transaction.status = new_status
-                        transaction.save()
-
-            # Return the status from our database
-            response_data = {
-                "order_id": transaction.order_id,
-                "order_tracking_id": transaction.order_tracking_id,
-                "status": transaction.status,
-                "updated_at": transaction.updated_at.isoformat(),
-            }
+            # Served from the status cache; PENDING transactions are re-checked with
+            # Pesapal at most once per PESAPAL_STATUS_MIN_CHECK_INTERVAL.
+            response_data = get_transaction_status(order_tracking_id, check_transaction_status)
             return Response(response_data, status=status.HTTP_200_OK)
         except PesapalTransaction.DoesNotExist:
             return Response(
@@ -176,3 +262,150 @@ class PesapalCheckStatusView(APIView):
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+
+
+class ArchivedTransactionView(APIView):
+    """
+    Read-only lookup of a transaction that has been archived (see pesapal.archive).
+    Users see their own transactions; staff see all.
+    """
+
+    permission_classes = [IsAuthenticated]
+    # User lookup on a cache miss, archive lookup.
+    query_budget = 2
+
+    def get(self, request, order_tracking_id):
+        archived = ArchivedTransaction.objects.filter(order_tracking_id=order_tracking_id)
+        if not request.user.is_staff:
+            archived = archived.filter(user=request.user)
+        with use_replica():
+            transaction = archived.first()
+        if transaction is None:
+            return Response(
+                {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(
+            {
+                **status_payload(transaction),
+                "amount": str(transaction.amount),
+                "created_at": transaction.created_at.isoformat(),
+                "archived_at": transaction.archived_at.isoformat(),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class TransactionHistoryView(APIView):
+    """
+    The authenticated user's transactions, newest first.
+
+    Pages are keyset-paginated on (created_at, id) through pesapal_user_history_idx, so
+    any page costs the same as the first: pass the `next` cursor of a page as `cursor`
+    to get the following one, and `limit` to change the page size. Responses carry an
+    ETag; a request with a matching If-None-Match gets 304 Not Modified.
+    """
+
+    # Only the user's id is needed, which the token carries.
+    authentication_classes = [ClaimsJWTAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+    # Page lookup.
+    query_budget = 1
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get("limit", settings.PESAPAL_HISTORY_PAGE_SIZE))
+        except ValueError:
+            return Response({"error": "limit must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.PESAPAL_HISTORY_MAX_PAGE_SIZE))
+
+        transactions = PesapalTransaction.objects.filter(user_id=request.user.pk)
+        cursor = request.query_params.get("cursor")
+        if cursor:
+            position = decode_history_cursor(cursor)
+            if position is None:
+                return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+            created_at, pk = position
+            transactions = transactions.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        with use_replica():
+            # One row past the page tells whether there is a next one.
+            page = list(transactions.order_by("-created_at", "-id")[:limit + 1])
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_history_cursor(page[-1].created_at, page[-1].pk)
+        etag = quote_etag(hashlib.md5(
+            "|".join([f"{t.pk}:{t.status}:{t.updated_at.isoformat()}" for t in page] + [next_cursor or ""]).encode()
+        ).hexdigest())
+
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(
+                {
+                    "results": [
+                        {
+                            **status_payload(transaction),
+                            "amount": str(transaction.amount),
+                            "description": transaction.description,
+                            "created_at": transaction.created_at.isoformat(),
+                        }
+                        for transaction in page
+                    ],
+                    "next": next_cursor,
+                },
+                status=status.HTTP_200_OK,
+            )
+        response["ETag"] = etag
+        # Per user, and revalidated on every use.
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class TransactionExportView(APIView):
+    """
+    Staff-only streaming export of transactions for finance (see pesapal.export).
+
+    Query parameters: `from` and `to` (dates or datetimes, on created_at; a date as `to`
+    includes that day), `status` (repeatable), `output` (csv or ndjson) and `gzip`.
+    """
+
+    permission_classes = [IsAdminUser]
+    # User lookup on a cache miss; rows are read while the response streams, after the
+    # request has been budgeted.
+    query_budget = 1
+
+    def get(self, request):
+        params = request.query_params
+        export_format = params.get("output", "csv")
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                {"error": f"output must be one of: {', '.join(EXPORT_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        bounds = {}
+        for name in ("from", "to"):
+            value = params.get(name)
+            if value:
+                bounds[name] = parse_export_bound(value, end=name == "to")
+                if bounds[name] is None:
+                    return Response(
+                        {"error": f"Invalid '{name}' date"}, status=status.HTTP_400_BAD_REQUEST
+                    )
+        statuses = [value for values in params.getlist("status") for value in values.split(",") if value]
+        unknown = set(statuses) - {choice for choice, _ in PesapalTransaction.STATUS_CHOICES}
+        if unknown:
+            return Response(
+                {"error": f"Unknown status: {', '.join(sorted(unknown))}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        compress = params.get("gzip", "").lower() in ("true", "1")
+
+        response = StreamingHttpResponse(
+            stream_export(bounds.get("from"), bounds.get("to"), statuses, export_format, compress),
+            content_type="application/gzip" if compress else (
+                "text/csv" if export_format == "csv" else "application/x-ndjson"
+            ),
+        )
+        response["Content-Disposition"] = f'attachment; filename="{export_filename(export_format, compress)}"'
+        return response
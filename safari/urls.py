@@ -17,6 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from pesapal.metrics import metrics_view
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -35,4 +36,7 @@ urlpatterns = [
     path('api/social/google/', include('allauth.socialaccount.providers.google.urls')),
 
     path('api/pesapal/', include('pesapal.urls')),
+
+    # Prometheus scrape endpoint; keep it off the public internet (proxy/network rules)
+    path('metrics/', metrics_view, name='metrics'),
 ]
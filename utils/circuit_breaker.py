@@ -0,0 +1,157 @@
+import logging
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker whose state lives in the Django cache, so every web worker and Celery
+# process sharing the cache (Redis in production) sees the same state.
+#
+# closed     calls go through; consecutive failures are counted, and failures older
+#            than failure_window seconds are forgotten.
+# open       after failure_threshold failures; calls are rejected with CircuitOpenError
+#            for recovery_timeout seconds without touching the network.
+# half-open  afterwards up to half_open_probes calls at a time are let through; a
+#            success closes the breaker, a failure opens it again.
+
+CLOSED = "closed"
+FAILING = "failing"  # closed, with failures counted
+PROBE = "probe"      # half-open, this call is a probe
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit '{name}' is open; not calling the service")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, failure_window=60, recovery_timeout=30,
+                 half_open_probes=1, probe_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.recovery_timeout = recovery_timeout
+        self.half_open_probes = half_open_probes
+        # A probe slot is released after this long even if its call never reports back.
+        self.probe_timeout = probe_timeout
+        self.open_key = f"circuit:{name}:open"
+        self.tripped_key = f"circuit:{name}:tripped"
+        self.failures_key = f"circuit:{name}:failures"
+        self.probes_key = f"circuit:{name}:probes"
+
+    def _state(self, values):
+        if self.open_key in values:
+            raise CircuitOpenError(self.name, self.recovery_timeout)
+        if self.tripped_key in values:
+            return PROBE
+        return FAILING if values.get(self.failures_key) else CLOSED
+
+    def is_open(self):
+        """True while calls are being rejected outright (not while half-open)."""
+        return cache.get(self.open_key) is not None
+
+    def before_call(self):
+        """
+        Return the state to pass to record_success()/record_failure() after the call,
+        or raise CircuitOpenError if the call must not be made.
+        """
+        state = self._state(cache.get_many([self.open_key, self.tripped_key, self.failures_key]))
+        if state == PROBE:
+            cache.add(self.probes_key, 0, timeout=self.probe_timeout)
+            if self._incr(self.probes_key, self.probe_timeout) > self.half_open_probes:
+                raise CircuitOpenError(self.name, self.recovery_timeout)
+        return state
+
+    def cancel(self, state):
+        """Undo before_call() for a call that was not made after all (frees its probe slot)."""
+        if state == PROBE:
+            try:
+                cache.decr(self.probes_key)
+            except ValueError:
+                pass
+
+    def record_success(self, state):
+        if state == PROBE:
+            cache.delete_many([self.tripped_key, self.probes_key, self.failures_key])
+            logger.info(f"Circuit '{self.name}' closed after a successful probe.")
+        elif state == FAILING:
+            cache.delete(self.failures_key)
+
+    def record_failure(self, state):
+        if state == PROBE:
+            self._open("probe failed")
+            return
+        cache.add(self.failures_key, 0, timeout=self.failure_window)
+        failures = self._incr(self.failures_key, self.failure_window)
+        if failures >= self.failure_threshold:
+            self._open(f"{failures} consecutive failures")
+
+    def _open(self, reason):
+        # add() so that only the process that trips the breaker reports it.
+        opened = cache.add(self.open_key, True, timeout=self.recovery_timeout)
+        cache.set(self.tripped_key, True, timeout=None)
+        cache.delete_many([self.failures_key, self.probes_key])
+        if opened:
+            logger.warning(f"Circuit '{self.name}' opened ({reason}); rejecting calls for {self.recovery_timeout}s.")
+        return opened
+
+    def _incr(self, key, timeout):
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # The key expired between add() and incr().
+            cache.add(key, 1, timeout=timeout)
+            return 1
+
+    # Async versions, for the async client; they share the same cache keys.
+
+    async def ais_open(self):
+        return await cache.aget(self.open_key) is not None
+
+    async def abefore_call(self):
+        state = self._state(await cache.aget_many([self.open_key, self.tripped_key, self.failures_key]))
+        if state == PROBE:
+            await cache.aadd(self.probes_key, 0, timeout=self.probe_timeout)
+            if await self._aincr(self.probes_key, self.probe_timeout) > self.half_open_probes:
+                raise CircuitOpenError(self.name, self.recovery_timeout)
+        return state
+
+    async def acancel(self, state):
+        if state == PROBE:
+            try:
+                await cache.adecr(self.probes_key)
+            except ValueError:
+                pass
+
+    async def arecord_success(self, state):
+        if state == PROBE:
+            await cache.adelete_many([self.tripped_key, self.probes_key, self.failures_key])
+            logger.info(f"Circuit '{self.name}' closed after a successful probe.")
+        elif state == FAILING:
+            await cache.adelete(self.failures_key)
+
+    async def arecord_failure(self, state):
+        if state == PROBE:
+            await self._aopen("probe failed")
+            return
+        await cache.aadd(self.failures_key, 0, timeout=self.failure_window)
+        failures = await self._aincr(self.failures_key, self.failure_window)
+        if failures >= self.failure_threshold:
+            await self._aopen(f"{failures} consecutive failures")
+
+    async def _aopen(self, reason):
+        opened = await cache.aadd(self.open_key, True, timeout=self.recovery_timeout)
+        await cache.aset(self.tripped_key, True, timeout=None)
+        await cache.adelete_many([self.failures_key, self.probes_key])
+        if opened:
+            logger.warning(f"Circuit '{self.name}' opened ({reason}); rejecting calls for {self.recovery_timeout}s.")
+        return opened
+
+    async def _aincr(self, key, timeout):
+        try:
+            return await cache.aincr(key)
+        except ValueError:
+            await cache.aadd(key, 1, timeout=timeout)
+            return 1
@@ -1,38 +1,530 @@
-import requests
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from datetime import timedelta, timezone as dt_timezone
+
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-def get_access_token():
-    """Get Pesapal OAuth token"""
-    url = f"{settings.PESAPAL_BASE_URL}/Auth/RequestToken"
-    data = {
+from pesapal.metrics import (
+    record_rate_limit_rejection,
+    record_rate_limit_wait,
+    record_upstream_call,
+    record_upstream_rejection,
+)
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from utils.rate_limiter import BACKGROUND, INTERACTIVE, RateLimited, TokenBucket
+
+# requests and httpx are imported by the client that uses them, on its first call, so
+# processes importing this module (every web and worker process, through pesapal.tasks)
+# don't pay for both at boot.
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_KEY = "pesapal:access_token"
+TOKEN_LOCK_KEY = "pesapal:access_token:lock"
+
+# Pesapal tokens are valid for five minutes; used when expiryDate is missing or unparseable.
+DEFAULT_TOKEN_LIFETIME = 300
+
+
+class BasePesapalClient:
+    """
+    Configuration, retry policy, rate limiter and circuit breaker shared by the sync and
+    async Pesapal clients. Connection errors, timeouts and retryable statuses count as
+    failures; while the breaker is open calls raise CircuitOpenError immediately.
+
+    Every attempt takes a token from the rate limiter shared by all processes, waiting
+    for one if needed; calls made with priority=BACKGROUND (reconciliation) give way to
+    INTERACTIVE ones and raise RateLimited when no token comes within their wait limit.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, base_url=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, retry_backoff=None, retry_backoff_max=None, pool_maxsize=None):
+        self.base_url = base_url or settings.PESAPAL_BASE_URL
+        self.connect_timeout = (
+            connect_timeout if connect_timeout is not None else settings.PESAPAL_CONNECT_TIMEOUT
+        )
+        self.read_timeout = read_timeout if read_timeout is not None else settings.PESAPAL_READ_TIMEOUT
+        self.max_retries = max_retries if max_retries is not None else settings.PESAPAL_MAX_RETRIES
+        self.retry_backoff = retry_backoff if retry_backoff is not None else settings.PESAPAL_RETRY_BACKOFF
+        self.retry_backoff_max = (
+            retry_backoff_max if retry_backoff_max is not None else settings.PESAPAL_RETRY_BACKOFF_MAX
+        )
+        self.pool_maxsize = pool_maxsize or settings.PESAPAL_POOL_MAXSIZE
+        self.retries = 0
+        self.breaker = CircuitBreaker(
+            "pesapal",
+            failure_threshold=settings.PESAPAL_BREAKER_FAILURE_THRESHOLD,
+            failure_window=settings.PESAPAL_BREAKER_FAILURE_WINDOW,
+            recovery_timeout=settings.PESAPAL_BREAKER_RECOVERY_TIMEOUT,
+            half_open_probes=settings.PESAPAL_BREAKER_HALF_OPEN_PROBES,
+            probe_timeout=int(self.connect_timeout + self.read_timeout) + 1,
+        )
+        self.limiter = None
+        if settings.PESAPAL_RATE_LIMIT:
+            self.limiter = TokenBucket(
+                "pesapal",
+                rate=settings.PESAPAL_RATE_LIMIT,
+                burst=settings.PESAPAL_RATE_LIMIT_BURST,
+                reserves={BACKGROUND: settings.PESAPAL_RATE_LIMIT_BACKGROUND_RESERVE},
+                max_waits={
+                    INTERACTIVE: settings.PESAPAL_RATE_LIMIT_MAX_WAIT,
+                    BACKGROUND: settings.PESAPAL_RATE_LIMIT_BACKGROUND_MAX_WAIT,
+                },
+                redis_url=settings.PESAPAL_RATE_LIMIT_REDIS_URL,
+            )
+
+    def _acquire(self, priority):
+        if self.limiter is None:
+            return
+        try:
+            record_rate_limit_wait(priority, self.limiter.acquire(priority))
+        except RateLimited:
+            record_rate_limit_rejection(priority)
+            raise
+
+    async def _aacquire(self, priority):
+        if self.limiter is None:
+            return
+        try:
+            record_rate_limit_wait(priority, await self.limiter.aacquire(priority))
+        except RateLimited:
+            record_rate_limit_rejection(priority)
+            raise
+
+    def _backoff_delay(self, attempt):
+        """Full jitter: a random delay up to the capped exponential backoff."""
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+
+
+class PesapalClient(BasePesapalClient):
+    """
+    HTTP client for the Pesapal v3 API.
+
+    Keeps one pooled keep-alive session per process (sessions are recreated after a
+    fork, e.g. in gunicorn or Celery prefork children), applies connect/read timeouts
+    to every call and retries idempotent calls with exponential backoff and jitter.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self._session = None
+        self._adapter = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session, self._adapter = self._new_session()
+                    self._pid = os.getpid()
+                    self.retries = 0
+        return self._session
+
+    def _new_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        # Retries are handled in request() so they can be limited to idempotent calls.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session, adapter
+
+    def request(self, method, path, *, idempotent=False, authenticated=True, priority=INTERACTIVE, **kwargs):
+        """
+        Send a request to Pesapal and return the decoded JSON body.
+
+        Idempotent calls are retried up to max_retries times on connection errors,
+        timeouts and retryable status codes. A rejected token is dropped and the call
+        is repeated once with a fresh one.
+        """
+        import requests
+
+        url = f"{self.base_url}{path}"
+        attempts = self.max_retries + 1 if idempotent else 1
+        token_retried = False
+        attempt = 0
+        while True:
+            headers = {"Accept": "application/json"}
+            if authenticated:
+                headers["Authorization"] = f"Bearer {get_access_token()}"
+            # Breaker first: calls it rejects must not wait for (or use up) a rate limit token.
+            try:
+                breaker_state = self.breaker.before_call()
+            except CircuitOpenError:
+                record_upstream_rejection(path)
+                raise
+            # The breaker hears about each call once, when it succeeds or gives up: attempts
+            # that are retried, rate limited or end in an unexpected error give back their
+            # probe slot instead.
+            reported = False
+            try:
+                self._acquire(priority)
+                started = time.perf_counter()
+                try:
+                    res = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    record_upstream_call(path, time.perf_counter() - started, type(e).__name__)
+                    attempt += 1
+                    if attempt >= attempts:
+                        self.breaker.record_failure(breaker_state)
+                        reported = True
+                        raise
+                    self.breaker.cancel(breaker_state)
+                    reported = True
+                    logger.warning(
+                        f"Pesapal {method} {path} failed ({e}); retrying (attempt {attempt + 1}/{attempts})"
+                    )
+                    self.retries += 1
+                    time.sleep(self._backoff_delay(attempt - 1))
+                    continue
+                record_upstream_call(
+                    path, time.perf_counter() - started, f"http_{res.status_code}" if res.status_code >= 400 else None
+                )
+                retrying = res.status_code in self.RETRY_STATUSES and attempt + 1 < attempts
+                if retrying:
+                    self.breaker.cancel(breaker_state)
+                elif res.status_code in self.RETRY_STATUSES:
+                    self.breaker.record_failure(breaker_state)
+                else:
+                    self.breaker.record_success(breaker_state)
+                reported = True
+            finally:
+                if not reported:
+                    self.breaker.cancel(breaker_state)
+
+            if res.status_code == 401 and authenticated and not token_retried:
+                invalidate_access_token()
+                token_retried = True
+                continue
+            if retrying:
+                attempt += 1
+                logger.warning(
+                    f"Pesapal {method} {path} returned {res.status_code}; retrying (attempt {attempt + 1}/{attempts})"
+                )
+                self.retries += 1
+                time.sleep(self._backoff_delay(attempt - 1))
+                continue
+            res.raise_for_status()
+            return res.json()
+
+    def connection_stats(self):
+        """Return request, new connection and retry counts for this process's pool."""
+        requests_sent = connections = 0
+        if self._adapter is not None and self._pid == os.getpid():
+            pools = self._adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return {
+            "requests": requests_sent,
+            "connections": connections,
+            "reuse_rate": 1 - connections / requests_sent if requests_sent else 0.0,
+            "retries": self.retries,
+        }
+
+
+class AsyncPesapalClient(BasePesapalClient):
+    """
+    Asyncio counterpart of PesapalClient, for the async views under ASGI.
+
+    httpx connection pools are bound to the event loop that created them, so one
+    AsyncClient is kept per running loop. Retry and token handling mirror the sync client.
+    """
+
+    def __init__(self, *args, max_connections=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_connections = max_connections or settings.PESAPAL_ASYNC_MAX_CONNECTIONS
+        self._clients = weakref.WeakKeyDictionary()
+
+    @property
+    def http(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            import httpx
+
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.pool_maxsize,
+                ),
+            )
+            self._clients[loop] = client
+        return client
+
+    async def request(self, method, path, *, idempotent=False, authenticated=True, priority=INTERACTIVE, **kwargs):
+        """Send a request to Pesapal and return the decoded JSON body (see PesapalClient.request)."""
+        import httpx
+
+        url = f"{self.base_url}{path}"
+        attempts = self.max_retries + 1 if idempotent else 1
+        token_retried = False
+        attempt = 0
+        while True:
+            headers = {"Accept": "application/json"}
+            if authenticated:
+                headers["Authorization"] = f"Bearer {await aget_access_token()}"
+            try:
+                breaker_state = await self.breaker.abefore_call()
+            except CircuitOpenError:
+                record_upstream_rejection(path)
+                raise
+            # The breaker hears about each call once, when it succeeds or gives up: attempts
+            # that are retried, rate limited or end in an unexpected error give back their
+            # probe slot instead.
+            reported = False
+            try:
+                await self._aacquire(priority)
+                started = time.perf_counter()
+                try:
+                    res = await self.http.request(method, url, headers=headers, **kwargs)
+                except httpx.TransportError as e:
+                    record_upstream_call(path, time.perf_counter() - started, type(e).__name__)
+                    attempt += 1
+                    if attempt >= attempts:
+                        await self.breaker.arecord_failure(breaker_state)
+                        reported = True
+                        raise
+                    await self.breaker.acancel(breaker_state)
+                    reported = True
+                    logger.warning(
+                        f"Pesapal {method} {path} failed ({e!r}); retrying (attempt {attempt + 1}/{attempts})"
+                    )
+                    self.retries += 1
+                    await asyncio.sleep(self._backoff_delay(attempt - 1))
+                    continue
+                record_upstream_call(
+                    path, time.perf_counter() - started, f"http_{res.status_code}" if res.status_code >= 400 else None
+                )
+                retrying = res.status_code in self.RETRY_STATUSES and attempt + 1 < attempts
+                if retrying:
+                    await self.breaker.acancel(breaker_state)
+                elif res.status_code in self.RETRY_STATUSES:
+                    await self.breaker.arecord_failure(breaker_state)
+                else:
+                    await self.breaker.arecord_success(breaker_state)
+                reported = True
+            finally:
+                if not reported:
+                    await self.breaker.acancel(breaker_state)
+
+            if res.status_code == 401 and authenticated and not token_retried:
+                await ainvalidate_access_token()
+                token_retried = True
+                continue
+            if retrying:
+                attempt += 1
+                logger.warning(
+                    f"Pesapal {method} {path} returned {res.status_code}; retrying (attempt {attempt + 1}/{attempts})"
+                )
+                self.retries += 1
+                await asyncio.sleep(self._backoff_delay(attempt - 1))
+                continue
+            res.raise_for_status()
+            return res.json()
+
+    async def aclose(self):
+        """Close the connection pool of the running event loop."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the shared PesapalClient for this process."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PesapalClient()
+    return _client
+
+
+_async_client = None
+
+
+def get_async_client():
+    """Return the shared AsyncPesapalClient for this process."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncPesapalClient()
+    return _async_client
+
+
+def _token_expiry(data: dict) -> float:
+    """Return the token expiry as a unix timestamp, based on Pesapal's expiryDate."""
+    now = time.time()
+    expires_at = parse_datetime(data.get("expiryDate") or "")
+    if expires_at is not None:
+        if timezone.is_naive(expires_at):
+            expires_at = timezone.make_aware(expires_at, dt_timezone.utc)
+        expiry = expires_at.timestamp()
+        # Guard against clock skew between us and Pesapal.
+        if now < expiry <= now + timedelta(hours=1).total_seconds():
+            return expiry
+    return now + DEFAULT_TOKEN_LIFETIME
+
+
+def _token_credentials():
+    return {
         "consumer_key": settings.PESAPAL_CONSUMER_KEY,
         "consumer_secret": settings.PESAPAL_CONSUMER_SECRET
     }
-    res = requests.post(url, json=data)
-    res.raise_for_status()
-    return res.json().get("token")
+
+
+def _token_cache_entry(body: dict):
+    """Return the cache entry and timeout for a RequestToken response."""
+    expires_at = _token_expiry(body)
+    entry = {
+        "token": body["token"],
+        "expires_at": expires_at,
+        "refresh_at": expires_at - settings.PESAPAL_TOKEN_REFRESH_MARGIN,
+    }
+    return entry, max(int(expires_at - time.time()), 1)
+
+
+def _request_access_token():
+    """Request a fresh token from Pesapal and store it in the shared cache."""
+    body = get_client().request(
+        "POST", "/Auth/RequestToken", json=_token_credentials(), authenticated=False, idempotent=True
+    )
+    token = body.get("token")
+    if token:
+        entry, timeout = _token_cache_entry(body)
+        cache.set(TOKEN_CACHE_KEY, entry, timeout=timeout)
+    return token
+
+
+async def _arequest_access_token():
+    body = await get_async_client().request(
+        "POST", "/Auth/RequestToken", json=_token_credentials(), authenticated=False, idempotent=True
+    )
+    token = body.get("token")
+    if token:
+        entry, timeout = _token_cache_entry(body)
+        await cache.aset(TOKEN_CACHE_KEY, entry, timeout=timeout)
+    return token
+
+
+def get_access_token():
+    """
+    Get Pesapal OAuth token.
+
+    The token is shared through the Django cache, so every web worker and Celery
+    process reuses it until shortly before it expires. Only the caller holding the
+    refresh lock talks to Pesapal; everyone else keeps using the current token or
+    waits for the refreshed one.
+    """
+    entry = cache.get(TOKEN_CACHE_KEY)
+    if entry and time.time() < entry["refresh_at"]:
+        return entry["token"]
+
+    lock_timeout = settings.PESAPAL_TOKEN_LOCK_TIMEOUT
+    if cache.add(TOKEN_LOCK_KEY, True, timeout=lock_timeout):
+        try:
+            return _request_access_token()
+        finally:
+            cache.delete(TOKEN_LOCK_KEY)
+
+    # Another process is refreshing. The old token is still usable until it expires.
+    if entry and time.time() < entry["expires_at"]:
+        return entry["token"]
+
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(TOKEN_CACHE_KEY)
+        if entry and time.time() < entry["expires_at"]:
+            return entry["token"]
+
+    # The refreshing process went away without storing a token; fetch one ourselves.
+    return _request_access_token()
+
+
+async def aget_access_token():
+    """Async version of get_access_token(); shares the same cache entry and lock."""
+    entry = await cache.aget(TOKEN_CACHE_KEY)
+    if entry and time.time() < entry["refresh_at"]:
+        return entry["token"]
+
+    lock_timeout = settings.PESAPAL_TOKEN_LOCK_TIMEOUT
+    if await cache.aadd(TOKEN_LOCK_KEY, True, timeout=lock_timeout):
+        try:
+            return await _arequest_access_token()
+        finally:
+            await cache.adelete(TOKEN_LOCK_KEY)
+
+    if entry and time.time() < entry["expires_at"]:
+        return entry["token"]
+
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        entry = await cache.aget(TOKEN_CACHE_KEY)
+        if entry and time.time() < entry["expires_at"]:
+            return entry["token"]
+
+    return await _arequest_access_token()
+
+
+def invalidate_access_token():
+    """Drop the cached token, e.g. after Pesapal rejects it."""
+    cache.delete(TOKEN_CACHE_KEY)
+
+
+async def ainvalidate_access_token():
+    await cache.adelete(TOKEN_CACHE_KEY)
 
 
 def submit_order(payload: dict):
     """Submit order request to Pesapal"""
-    url = f"{settings.PESAPAL_BASE_URL}/Transactions/SubmitOrderRequest"
-    headers = {
-        "Authorization": f"Bearer {get_access_token()}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-    res = requests.post(url, json=payload, headers=headers)
-    res.raise_for_status()
-    return res.json()
+    # Not retried: a timed-out submission may still have been accepted upstream.
+    return get_client().request("POST", "/Transactions/SubmitOrderRequest", json=payload)
 
 
-def check_transaction_status(order_tracking_id: str):
-    """Check payment status"""
-    url = f"{settings.PESAPAL_BASE_URL}/Transactions/GetTransactionStatus?orderTrackingId={order_tracking_id}"
-    headers = {
-        "Authorization": f"Bearer {get_access_token()}",
-        "Accept": "application/json",
-    }
-    res = requests.get(url, headers=headers)
-    res.raise_for_status()
-    return res.json()
+def check_transaction_status(order_tracking_id: str, priority=INTERACTIVE):
+    """Check payment status; background callers pass priority=BACKGROUND."""
+    return get_client().request(
+        "GET",
+        "/Transactions/GetTransactionStatus",
+        params={"orderTrackingId": order_tracking_id},
+        idempotent=True,
+        priority=priority,
+    )
+
+
+async def asubmit_order(payload: dict):
+    """Submit order request to Pesapal (async)"""
+    return await get_async_client().request("POST", "/Transactions/SubmitOrderRequest", json=payload)
+
+
+async def acheck_transaction_status(order_tracking_id: str, priority=INTERACTIVE):
+    """Check payment status (async)"""
+    return await get_async_client().request(
+        "GET",
+        "/Transactions/GetTransactionStatus",
+        params={"orderTrackingId": order_tracking_id},
+        idempotent=True,
+        priority=priority,
+    )
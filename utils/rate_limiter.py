@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# Token bucket shared by every process that talks to the same Redis: tokens refill at
+# `rate` per second up to `burst`, and each call takes one. Without Redis the bucket is
+# kept in-process, which limits each process separately (enough for development).
+#
+# Priority classes share the bucket but not its contents: a class may only take a token
+# while more than its reserve (a fraction of `burst`) would be left. Interactive calls
+# have no reserve, so background calls back off as soon as interactive traffic starts
+# eating into the bucket, and can never drain the burst capacity interactive calls rely on.
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Refill, try to take one token while staying above the floor, and store the new level.
+# Returns {1, 0} or {0, seconds until a token would be available}. Uses the Redis clock,
+# so processes on hosts with skewed clocks agree.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local floor = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens - 1 >= floor then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (floor + 1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class RateLimited(Exception):
+    def __init__(self, name, priority, retry_after):
+        super().__init__(f"Rate limit '{name}' exhausted for {priority} calls")
+        self.name = name
+        self.priority = priority
+        # Whole seconds, like CircuitOpenError, so it can go into a Retry-After header.
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, name, rate, burst, reserves=None, max_waits=None, redis_url=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # Fraction of the burst each priority class must leave in the bucket.
+        self.reserves = reserves or {}
+        # How long each priority class may wait for a token before RateLimited.
+        self.max_waits = max_waits or {}
+        self.key = f"ratelimit:{name}"
+        self.redis_url = redis_url
+        self._redis = None
+        self._script = None
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _floor(self, priority):
+        return self.burst * self.reserves.get(priority, 0)
+
+    def _take(self, priority):
+        """Try to take a token; returns the wait in seconds, 0 when one was taken."""
+        if self.redis_url:
+            if self._script is None:
+                import redis
+
+                self._redis = redis.Redis.from_url(self.redis_url)
+                self._script = self._redis.register_script(TOKEN_BUCKET_SCRIPT)
+            allowed, wait = self._script(keys=[self.key], args=[self.rate, self.burst, self._floor(priority)])
+            return 0 if int(allowed) else float(wait)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            floor = self._floor(priority)
+            if self._tokens - 1 >= floor:
+                self._tokens -= 1
+                return 0
+            return (floor + 1 - self._tokens) / self.rate
+
+    def acquire(self, priority=INTERACTIVE):
+        """Wait for a token; returns the seconds waited or raises RateLimited."""
+        started = time.monotonic()
+        deadline = started + self.max_waits.get(priority, 0)
+        while True:
+            wait = self._take(priority)
+            if not wait:
+                return time.monotonic() - started
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(self.name, priority, wait)
+            time.sleep(wait)
+
+    async def aacquire(self, priority=INTERACTIVE):
+        started = time.monotonic()
+        deadline = started + self.max_waits.get(priority, 0)
+        while True:
+            if self.redis_url:
+                # The Redis round trip runs in a thread so the event loop is not blocked.
+                wait = await sync_to_async(self._take, thread_sensitive=False)(priority)
+            else:
+                wait = self._take(priority)
+            if not wait:
+                return time.monotonic() - started
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(self.name, priority, wait)
+            await asyncio.sleep(wait)